@@ -0,0 +1,301 @@
+
+"""
+UBF messages over asyncio streams.
+
+The messages are recognized with pyubf.IncrementalRecognitionStack
+from chunks read off asyncio.StreamReader,
+and written with pyubf.encode.
+UBFClient calls a UBF server over a pool of pipelined connections.
+"""
+
+import asyncio
+import collections
+import time
+
+import pyubf
+
+
+async def ubf_messages(reader: asyncio.StreamReader, chunk_size: int = 1 << 16, limits: pyubf.Limits = None):
+    """ubf_messages(reader, chunk_size = 1 << 16, limits = None)
+
+    Asynchronous iterator over the UBF messages read from the reader:
+
+        async for msg in ubf_messages(reader):
+            ...
+
+    Reads up to chunk_size bytes at a time.
+    Ends at the end of the stream, the last message may end without $.
+    A message over the pyubf.Limits given as limits raises pyubf.LimitExceeded.
+    """
+
+    parser = pyubf.IncrementalRecognitionStack(limits=limits)
+    while True:
+        data = await reader.read(chunk_size)
+        if not data:
+            break
+        for msg in parser.feed(data):
+            yield msg
+
+    for msg in parser.close():
+        yield msg
+
+
+class UBFWriter:
+    """
+    Encodes UBF messages into asyncio.StreamWriter
+    and waits for the transport to drain.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    async def write(self, element):
+        self.writer.write(pyubf.encode(element))
+        await self.writer.drain()
+
+    async def write_many(self, elements):
+        """write_many(self, elements)
+
+        Writes all the messages with one drain at the end.
+        """
+
+        self.writer.writelines([pyubf.encode(element) for element in elements])
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+# RPC client
+#
+# The requests are pipelined: written without waiting for the responses,
+# which the server sends back in the order of the requests.
+
+class _Connection:
+    """
+    One connection of UBFClient,
+    with the futures of the requests in flight, oldest first.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_in_flight: int):
+        self.out = UBFWriter(writer)
+        self.waiting = collections.deque()
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.closed = False
+        self.reading = asyncio.ensure_future(self._read_responses(reader))
+
+    async def call(self, element):
+        async with self.slots:
+            if self.closed:
+                raise ConnectionError("UBF connection is closed")
+            # an element which does not encode fails here, with nothing queued or written
+            request = pyubf.encode(element)
+            response = asyncio.get_running_loop().create_future()
+            # queued before the request is written, nothing can come in between
+            self.waiting.append(response)
+            try:
+                self.out.writer.write(request)
+                await self.out.writer.drain()
+            except BaseException:
+                # the request may be written in part, and its response would go
+                # to the next call: the calls in flight fail with the connection
+                self.waiting.remove(response)
+                self.closed = True
+                self.out.writer.close()
+                raise
+            return await response
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        error = None
+        try:
+            async for msg in ubf_messages(reader):
+                if not self.waiting:
+                    raise pyubf.FormatError("UBF response without a request: %s" % (msg,))
+                response = self.waiting.popleft()
+                if not response.done():
+                    response.set_result(msg)
+        except Exception as e:
+            error = e
+        finally:
+            self.closed = True
+            while self.waiting:
+                response = self.waiting.popleft()
+                if not response.done():
+                    response.set_exception(error or ConnectionError("UBF connection closed with requests in flight"))
+
+    async def close(self):
+        # also once the connection closed itself, and any number of times
+        self.closed = True
+        self.out.writer.close()
+        try:
+            await self.out.writer.wait_closed()
+        except OSError:
+            pass # lost, closed all the same
+        await self.reading
+
+class UBFClient:
+    """UBFClient(host, port, pool_size = 4, max_in_flight = 32)
+
+    Calls a UBF server over a pool of pool_size connections:
+
+        async with UBFClient(host, port) as client:
+            response = await client.call(request)
+
+    Each call goes to the connection with the fewest requests in flight,
+    up to max_in_flight on a connection, without waiting for the earlier responses.
+    The server must answer the requests of a connection in order, one message each.
+
+    A closed connection fails its calls in flight with ConnectionError
+    (or the FormatError of a bad response), and is opened again by the next call.
+    """
+
+    def __init__(self, host: str, port: int, pool_size: int = 4, max_in_flight: int = 32):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.max_in_flight = max_in_flight
+        self._connections = [None] * pool_size
+        self._calls = [0] * pool_size # on each connection, in flight or waiting for a slot
+        self._opening = [None] * pool_size
+
+    async def _connection(self, i: int) -> _Connection:
+        connection = self._connections[i]
+        if connection is None or connection.closed:
+            if self._opening[i] is None:
+                self._opening[i] = asyncio.Lock()
+            async with self._opening[i]:
+                # another call may have opened it meanwhile
+                connection = self._connections[i]
+                if connection is None or connection.closed:
+                    if connection is not None:
+                        await connection.close()
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+                    connection = self._connections[i] = _Connection(reader, writer, self.max_in_flight)
+        return connection
+
+    async def call(self, element):
+        """call(self, element)
+
+        Sends the UBF element and returns the response element.
+        """
+
+        i = min(range(self.pool_size), key=self._calls.__getitem__)
+        self._calls[i] += 1
+        try:
+            return await (await self._connection(i)).call(element)
+        finally:
+            self._calls[i] -= 1
+
+    async def call_many(self, elements) -> list:
+        """call_many(self, elements)
+
+        Sends all the elements at once, returns the list of the responses.
+        """
+
+        return await asyncio.gather(*(self.call(element) for element in elements))
+
+    async def close(self):
+        for connection in self._connections:
+            if connection is not None:
+                await connection.close()
+        self._connections = [None] * self.pool_size
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+if __name__ == '__main__':
+    async def echo(reader, writer):
+        out = UBFWriter(writer)
+        async for msg in ubf_messages(reader):
+            await out.write(msg)
+        await out.close()
+
+    async def distant_echo(reader, writer):
+        # answers 1 ms later, as a server across the network
+        loop = asyncio.get_running_loop()
+        out = UBFWriter(writer)
+        answers = asyncio.Queue()
+
+        async def answer():
+            while True:
+                when, msg = await answers.get()
+                if msg is None:
+                    break
+                await asyncio.sleep(when - loop.time())
+                await out.write(msg)
+
+        answering = asyncio.ensure_future(answer())
+        async for msg in ubf_messages(reader):
+            answers.put_nowait((loop.time() + 0.001, msg))
+        answers.put_nowait((None, None))
+        await answering
+        await out.close()
+
+    async def main():
+        server = await asyncio.start_server(echo, "127.0.0.1", 0)
+        host, port = server.sockets[0].getsockname()[:2]
+
+        reader, writer = await asyncio.open_connection(host, port)
+        out = UBFWriter(writer)
+        sent = [pyubf.UBF_Tuple((pyubf.UBF_Int(i), pyubf.UBF_Str("foo"), pyubf.UBF_Bin(b"ab$~"))) for i in range(3)]
+        await out.write_many(sent)
+        writer.write_eof()
+
+        print("running tests:")
+        async for msg in ubf_messages(reader):
+            print(msg)
+
+        await out.close()
+        server.close()
+        await server.wait_closed()
+
+        print("pipelined calls:")
+        requests = [pyubf.UBF_Tuple((pyubf.UBF_Const("echo"), pyubf.UBF_Int(i))) for i in range(2000)]
+        for handler in (echo, distant_echo):
+            handlers = set()
+            async def serve(reader, writer):
+                handlers.add(asyncio.current_task())
+                await handler(reader, writer)
+
+            server = await asyncio.start_server(serve, "127.0.0.1", 0)
+            host, port = server.sockets[0].getsockname()[:2]
+            for pool_size, max_in_flight in ((1, 1), (1, 32), (4, 32)):
+                async with UBFClient(host, port, pool_size, max_in_flight) as client:
+                    start = time.perf_counter()
+                    responses = await client.call_many(requests)
+                    seconds = time.perf_counter() - start
+                assert responses == requests
+                print("%-13s pool %d, in flight %2d: %6.0f calls/s" % (handler.__name__, pool_size, max_in_flight, len(requests) / seconds))
+            await asyncio.gather(*handlers)
+            server.close()
+            await server.wait_closed()
+
+        print("closing dropped connections:")
+        async def drop(reader, writer):
+            await reader.read(1)
+            writer.close()
+
+        server = await asyncio.start_server(drop, "127.0.0.1", 0)
+        host, port = server.sockets[0].getsockname()[:2]
+        client = UBFClient(host, port, pool_size=1)
+        try:
+            await client.call(requests[0])
+        except ConnectionError:
+            pass
+        else:
+            raise AssertionError("call on a dropped connection answered")
+        dropped = client._connections[0]
+        assert dropped.closed
+        await client.close()
+        assert dropped.out.writer.is_closing() and dropped.reading.done()
+        await dropped.close()
+        server.close()
+        await server.wait_closed()
+        print("ok")
+
+    asyncio.run(main())
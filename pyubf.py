@@ -30,34 +30,189 @@ UBF parsed in Python 3
 A symbol type. Symbols differ from strings in that you can test equality by comparing a pointer.
 """
 
+import array
+import collections
+import concurrent.futures
 import io
+import mmap
+import os
+import re
+import sys
+import tempfile
+import time
+import weakref
+import zlib
 
 
 # UBF elements
+# have no __dict__, the semantic tag is kept only by the tagged elements below
+
+def _uninterning(table: dict, key):
+    # the callback of the weak reference in the table,
+    # unless the key was interned again
+    def drop(ref):
+        if table.get(key) is ref:
+            del table[key]
+    return drop
 
 class UBF_Element:
+    __slots__ = ()
     semantic_tag = None
 
 class UBF_Int(int, UBF_Element):
-    pass
+    __slots__ = ()
 
 class UBF_Str(str, UBF_Element):
-    pass
+    __slots__ = ()
 
 class UBF_Const(str, UBF_Element):
+    """
+    Equal constants are one object, interned in UBF_Const.interned,
+    so they compare by identity.
+    The table holds weak references, a constant no longer used is dropped,
+    so decoding many different constants does not grow it for good.
+    """
     # TODO: add limit on string length?
-    pass
+    __slots__ = ("__weakref__",)
+    interned = {} # value: weak reference to the constant
+
+    def __new__(cls, value = ""):
+        if cls is not UBF_Const:
+            # the tagged constants are not shared
+            return str.__new__(cls, value)
+        ref = UBF_Const.interned.get(value)
+        const = ref() if ref is not None else None
+        if const is None:
+            const = str.__new__(cls, value)
+            value = str(const)
+            UBF_Const.interned[value] = weakref.ref(const, _uninterning(UBF_Const.interned, value))
+        return const
 
 class UBF_Bin(bytes, UBF_Element):
-    pass
+    __slots__ = ()
 
 
 class UBF_Tuple(tuple, UBF_Element):
-    pass
+    __slots__ = ()
 
 class UBF_List(list, UBF_Element):
+    __slots__ = ()
+
+
+# tuples and lists of integers only, see int_arrays of the recognition stacks
+
+class UBF_IntTuple(array.array, UBF_Element):
+    """
+    A tuple of 64-bit integers, as array("q").
+    """
+    __slots__ = ()
+
+    def __new__(cls, values = ()):
+        return array.array.__new__(cls, "q", values)
+
+    def __reduce__(self):
+        return self.__class__, (self.tolist(),), getattr(self, "__dict__", None)
+
+class UBF_IntList(UBF_IntTuple):
+    """
+    A list of 64-bit integers, as array("q").
+    """
+    __slots__ = ()
+
+
+class UBF_BinFile(UBF_Element):
+    """
+    A binary in a file: the recognition stacks spill the binaries
+    longer than their spill_size into temporary files,
+    deleted when closed.
+
+    Reads as the file, the binary starts at 0;
+    len() is the length of the binary.
+    """
+    __slots__ = ("file", "length")
+
+    def __init__(self, file, length: int = None):
+        if isinstance(file, UBF_BinFile):
+            # a copy sharing the file, as tagged makes
+            file, length = file.file, file.length
+        self.file = file
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "UBF_BinFile(%r, %d)" % (self.file, self.length)
+
+
+# the elements with a semantic tag, in their __dict__
+
+class _TaggedInt(UBF_Int):
+    pass
+
+class _TaggedStr(UBF_Str):
+    pass
+
+class _TaggedConst(UBF_Const):
     pass
 
+class _TaggedBin(UBF_Bin):
+    pass
+
+class _TaggedTuple(UBF_Tuple):
+    pass
+
+class _TaggedList(UBF_List):
+    pass
+
+class _TaggedIntTuple(UBF_IntTuple):
+    pass
+
+class _TaggedIntList(UBF_IntList):
+    pass
+
+class _TaggedBinFile(UBF_BinFile):
+    pass
+
+_tagged_types = {}
+for _types in ((UBF_Int, _TaggedInt, int), (UBF_Str, _TaggedStr, str),
+               (UBF_Const, _TaggedConst), (UBF_Bin, _TaggedBin, bytes, memoryview),
+               (UBF_Tuple, _TaggedTuple, tuple), (UBF_List, _TaggedList, list),
+               (UBF_IntTuple, _TaggedIntTuple), (UBF_IntList, _TaggedIntList),
+               (UBF_BinFile, _TaggedBinFile)):
+    for _type in _types:
+        _tagged_types[_type] = _types[1]
+del _types, _type
+
+def tagged(element, tag):
+    """tagged(element, tag)
+
+    Returns a copy of the element with the semantic tag,
+    the untagged elements can not keep one.
+    """
+
+    for cls in type(element).__mro__:
+        if cls in _tagged_types:
+            element = _tagged_types[cls](element)
+            element.semantic_tag = tag
+            return element
+    raise FormatError("Can not tag %s" % type(element))
+
 
 
 # UBF reserved characters
@@ -76,6 +231,170 @@ tuple_end_b  = b"}"
 list_b  = b"#"
 append_b = b"&"
 end_b = b"$"
+bind_b = b">"
+backslash_b = b"\\"
+
+# any other byte is a register
+reserved_b = (int_b + minus_b + tilde_b + stringquote + constquote + semanticquote + whitespace
+              + comment_b + tuple_open_b + tuple_end_b + list_b + append_b + end_b + bind_b)
+
+text_encoding = "utf-8" # of UBF_Str and UBF_Const contents
+
+
+class FormatError(TypeError):
+    pass
+
+class EndOfStream(FormatError):
+    pass
+
+def _not_text(what: str, at: int):
+    return FormatError("%s is not %s text at %d" % (what, text_encoding, at))
+
+class LimitExceeded(FormatError):
+    pass
+
+
+# Statistics
+#
+# The recognition stacks and the encoder take stats = callback,
+# called with MessageStats after each message.
+# Without the callback only the register hits and binds are counted.
+
+class MessageStats:
+    """
+    Statistics of one message:
+        operation     -- "decode" or "encode"
+        bytes         -- length of the message
+        counts        -- {"int", "str", "const", "bin", "tuple", "list", "tag": number of elements},
+                         an element read from a register is counted again
+        depth         -- the deepest nesting of tuples, lists and tags
+        register_hits -- elements read from (or written as) a register
+        binds         -- elements bound to a register
+        seconds       -- wall time spent on the message
+    """
+    __slots__ = ("operation", "bytes", "counts", "depth", "register_hits", "binds", "seconds")
+
+    def __init__(self, operation, bytes, counts, depth, register_hits, binds, seconds):
+        self.operation = operation
+        self.bytes = bytes
+        self.counts = counts
+        self.depth = depth
+        self.register_hits = register_hits
+        self.binds = binds
+        self.seconds = seconds
+
+    def __repr__(self):
+        return "MessageStats(%s)" % ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__)
+
+class StatsCounter:
+    """
+    Sums the MessageStats it is called with,
+    pass it as stats to aggregate over a connection:
+
+        counter = StatsCounter()
+        stack = BufferedRecognitionStack(sock.makefile("rb"), stats=counter)
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.counts = collections.Counter()
+        self.max_depth = 0
+        self.register_hits = 0
+        self.binds = 0
+        self.seconds = 0.0
+
+    def __call__(self, stats: MessageStats):
+        self.messages += 1
+        self.bytes += stats.bytes
+        self.counts.update(stats.counts)
+        self.max_depth = max(self.max_depth, stats.depth)
+        self.register_hits += stats.register_hits
+        self.binds += stats.binds
+        self.seconds += stats.seconds
+
+    def __repr__(self):
+        return "<StatsCounter %d messages, %d bytes, %.3f s, max depth %d, %d register hits, %d binds, %s>" % \
+               (self.messages, self.bytes, self.seconds, self.max_depth, self.register_hits, self.binds, dict(self.counts))
+
+def _element_counts(element):
+    """_element_counts(element)
+
+    Returns the counts of the elements by type and the depth of the element,
+    as in MessageStats.
+    """
+
+    counts = dict.fromkeys(("int", "str", "const", "bin", "tuple", "list", "tag"), 0)
+    depth = 0
+    todo = [(element, 0)]
+    while todo:
+        x, level = todo.pop()
+        depth = max(depth, level)
+        tag = getattr(x, "semantic_tag", None)
+        if tag is not None:
+            counts["tag"] += 1
+            todo.append((tag, level + 1))
+        if isinstance(x, int):
+            counts["int"] += 1
+        elif isinstance(x, UBF_Const):
+            counts["const"] += 1
+        elif isinstance(x, str):
+            counts["str"] += 1
+        elif isinstance(x, (bytes, bytearray, memoryview, UBF_BinFile)):
+            counts["bin"] += 1
+        elif isinstance(x, (UBF_IntList, list)):
+            counts["list"] += 1
+            if isinstance(x, UBF_IntList):
+                counts["int"] += len(x)
+                if len(x):
+                    depth = max(depth, level + 1)
+            else:
+                todo.extend((y, level + 1) for y in x)
+        else:
+            counts["tuple"] += 1
+            if isinstance(x, array.array) or _is_int_ndarray(x):
+                counts["int"] += len(x)
+                if len(x):
+                    depth = max(depth, level + 1)
+            else:
+                todo.extend((y, level + 1) for y in x)
+    return counts, depth
+
+# Limits
+#
+# The recognition stacks take limits = Limits(...),
+# checked while recognizing, before the element over a limit is allocated.
+
+class Limits:
+    """
+    Bounds of the messages a recognition stack accepts, None for no bound:
+        max_depth         -- tuples and semantic tags open one inside the other
+        max_message_bytes -- length of a message
+        max_binary        -- length of a binary
+        max_string        -- length of a string, constant or comment between its quotes, escapes included
+        max_registers     -- elements bound to a register in a message
+    A message going over one of them raises LimitExceeded.
+    """
+    __slots__ = ("max_depth", "max_message_bytes", "max_binary", "max_string", "max_registers")
+
+    def __init__(self, max_depth: int = None, max_message_bytes: int = None, max_binary: int = None, max_string: int = None, max_registers: int = None):
+        self.max_depth = max_depth
+        self.max_message_bytes = max_message_bytes
+        self.max_binary = max_binary
+        self.max_string = max_string
+        self.max_registers = max_registers
+
+    def __repr__(self):
+        return "Limits(%s)" % ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__)
+
+    def _bounds(self) -> tuple:
+        # the limits in the order of __slots__, without None, for plain comparisons in _scan
+        return tuple(sys.maxsize if getattr(self, k) is None else getattr(self, k) for k in self.__slots__)
+
+_NO_BOUNDS = Limits()._bounds()
+
+# frames of the open tuples and semantic tags on the recognition stack
+_FRAME_TUPLE, _FRAME_TAG = 0, 1
 
 # awesome state machinning with classes as states!
 
@@ -89,9 +408,10 @@ class RecognitionStack_None:
     Keeps a stack (list) of recognized UBF elements
     and a pool (bytes) for the current element.
     Reeds bytes stream, updating the current element pool or the stack.
+    A message over the Limits given as limits raises LimitExceeded.
     """
 
-    def __init__(self, stream: "byte_stream" = None, stream_bytes_read: int = 0, in_tuple: bool = False, end_bytes: bytes = end_b):
+    def __init__(self, stream: "byte_stream" = None, stream_bytes_read: int = 0, in_tuple: bool = False, end_bytes: bytes = end_b, registers: list = None, session: bool = False, stats = None, spill_size: int = None, limits: Limits = None):
         #print("rec stac in_tuple = %s" % in_tuple)
         if type(stream) is bytes:
             self.stream = io.BytesIO(stream)
@@ -102,12 +422,23 @@ class RecognitionStack_None:
 
         self.stream_bytes_read = stream_bytes_read
         self.recognized_stack = []
+        # (_FRAME_*, index of the first element of the frame in the stack)
+        # nested tuples and tags are recognized on the same stack
+        self._frames = []
         #self.actions = actions
         #self._state = None # no element recognition was started
         # the state is done with classes
         self._pool  = None # no current elements being recognized
         self.in_tuple = in_tuple
         self.recognition_ended = False
+        # the elements bound with >, indexed by the register byte
+        self.registers = [None] * 256 if registers is None else registers
+        self.session = session # keep the registers from one message to the next
+        self.stats = stats # called with MessageStats of each message
+        self._hits = self._binds = 0
+        self.spill_size = spill_size # longer binaries are UBF_BinFile
+        self.limits = limits # Limits of the messages, LimitExceeded when over them
+        self._set_bounds()
         #self.current_pool = None
         #self.current_recognition = (None, None)
         # will be (type-of-element, its'-pool)
@@ -126,6 +457,9 @@ class RecognitionStack_None:
         Logs number of bytes read in self.stream_bytes_read.
         """
 
+        if self.stats is not None:
+            started = time.perf_counter()
+
         if stream:
             self.stream = stream
             self.stream_bytes_read = 0
@@ -133,6 +467,8 @@ class RecognitionStack_None:
         if stream_bytes_read:
             self.stream_bytes_read = stream_bytes_read
 
+        self._set_bounds()
+        max_bytes = self._max_bytes
         while not self.recognition_ended:
             b = self.stream.read(1)
             #print(b)
@@ -140,11 +476,25 @@ class RecognitionStack_None:
                 # in case we don't block on empty stream
                 # --- treat empty stream like $ end of message
                 #return UBF_Tuple(self.recognized_stack), self.stream_bytes_read
+                if self.__class__ is RecognitionStack_Int:
+                    self.act(whitespace[:1]) # finish the number
                 break
             self.stream_bytes_read += 1
+            if self.stream_bytes_read > max_bytes:
+                _stack_over_limit(self, "Message", max_bytes)
 
             self.act(b)
 
+        if self.__class__ is not RecognitionStack_None:
+            raise FormatError("Stream ended inside an element at %d in %s" % (self.stream_bytes_read, self.stream))
+
+        # the end of stream closes the open tuples and tags
+        while self._frames:
+            if self._frames[-1][0] == _FRAME_TUPLE:
+                self._close_tuple()
+            else:
+                self._close_tag()
+
         if self.in_tuple:
             out = UBF_Tuple(self.recognized_stack)
         else:
@@ -153,14 +503,25 @@ class RecognitionStack_None:
             out = self.recognized_stack[0]
 
         out = out, self.stream_bytes_read
+        if self.stats is not None:
+            counts, depth = _element_counts(out[0])
+            self.stats(MessageStats("decode", out[1], counts, depth, self._hits, self._binds, time.perf_counter() - started))
 
         # return to initial state
         self.recognized_stack = []
+        self._frames = []
         self.stream_bytes_read = 0
         self.recognition_ended = False
+        self._hits = self._binds = 0
+        if not self.session:
+            self.registers = [None] * 256
 
         return out
 
+    def _set_bounds(self):
+        self._max_depth, self._max_bytes, self._max_binary, self._max_string, self._max_binds = \
+            _NO_BOUNDS if self.limits is None else self.limits._bounds()
+
     def act(self, byte: bytes):
         """act(self, byte: bytes)
 
@@ -170,21 +531,44 @@ class RecognitionStack_None:
         assert type(byte) == bytes
 
 
-        if byte in self.end_bytes:
-            assert not self.in_tuple
-            # "Did not expect end of message $ inside tuple, stream %s at %d" % (rc.stream, rc.stream_bytes_read)
-            self.recognition_ended = True
+        if byte == semanticquote or byte in self.end_bytes:
+            if self._frames and self._frames[-1][0] == _FRAME_TAG:
+                # the tag ends with ` or the end of message
+                self._close_tag()
+            elif byte in self.end_bytes and not self._frames:
+                assert not self.in_tuple
+                # "Did not expect end of message $ inside tuple, stream %s at %d" % (rc.stream, rc.stream_bytes_read)
+                self.recognition_ended = True
+            elif byte == semanticquote:
+                # recognize the stack until the next semantic quote
+                # and add the UBF element as semantic tag to the last element
+                if len(self.recognized_stack) <= (self._frames[-1][1] if self._frames else 0):
+                    raise FormatError("Semantic tag must follow an element at %d in %s" % (self.stream_bytes_read, self.stream))
+                if len(self._frames) >= self._max_depth:
+                    _stack_over_limit(self, "Depth of tuples and semantic tags", self._max_depth)
+                self._frames.append((_FRAME_TAG, len(self.recognized_stack)))
+            else:
+                raise FormatError("Did not expect end of message $ inside tuple at %d in %s" % (self.stream_bytes_read, self.stream))
 
         elif byte in int_b + minus_b:
             # enter Int recognition
             self.__class__ = RecognitionStack_Int
-            self._pool = byte
+            self._pool = bytearray(byte)
 
         elif byte == tilde_b:
             # enter-load-finish Bin recognition
             length = self.recognized_stack.pop()
             assert type(length) == UBF_Int
-            self.recognized_stack.append(UBF_Bin(self.stream.read(length)))
+            if length < 0:
+                raise FormatError("Negative binary length %d at %d in %s" % (length, self.stream_bytes_read, self.stream))
+            if length > self._max_binary:
+                _stack_over_limit(self, "Binary of length %d" % length, self._max_binary)
+            if self.stream_bytes_read + length > self._max_bytes:
+                _stack_over_limit(self, "Message", self._max_bytes)
+            if self.spill_size is not None and length > self.spill_size:
+                self.recognized_stack.append(_spill_stream(self.stream, length))
+            else:
+                self.recognized_stack.append(UBF_Bin(self.stream.read(length)))
             self.stream_bytes_read += length
             # check for final tilde
             b = self.stream.read(1)
@@ -192,24 +576,14 @@ class RecognitionStack_None:
             if b != tilde_b:
                 self.act(b)
 
-        elif byte == semanticquote:
-            # recognize the stack until the next semantic quote
-            # add the UBF element as semantic tag in current recognition
-            element, stream_bytes_read = RecognitionStack(self.stream, end_bytes = end_b + semanticquote).recognize()
-            self.recognized_stack[-1].semantic_tag = element
-            self.stream_bytes_read += stream_bytes_read # adding bytes read for tag
-            # so it will end with ` only,
-            # end-message character goes in:
-            #   in principle several UBF messages can be in the tag
-            #   but there is a check for only 1 UBF object..
-            # the state RecognitionStack_SemanticTag is not needed
-
         elif byte == stringquote:
             self.__class__ = RecognitionStack_Str
-            self._pool = bytes()
+            self._pool = bytearray()
+            self._quoted = 0 # bytes between the quotes, escapes included
         elif byte == constquote:
             self.__class__ = RecognitionStack_Const
-            self._pool = bytes()
+            self._pool = bytearray()
+            self._quoted = 0
 
         elif byte in whitespace:
             pass
@@ -219,28 +593,75 @@ class RecognitionStack_None:
         elif byte == append_b:
             self.recognized_stack[-2].append(self.recognized_stack.pop())
 
-        elif byte in self.end_bytes:
-            assert not self.in_tuple
-            # "Did not expect end of message $ inside tuple, stream %s at %d" % (rc.stream, rc.stream_bytes_read)
-            self.recognition_ended = True
-
         elif byte == tuple_open_b:
-            # the line is long indeed
-            # I'm making point that the recognition stack is temporary
-            tuple_element, stream_bytes_read = RecognitionStack(self.stream, in_tuple = True).recognize()
-            self.recognized_stack.append(tuple_element)
-            self.stream_bytes_read += stream_bytes_read # adding bytes read for tuple
+            # the tuple elements go on the same stack, after the frame marker
+            if len(self._frames) >= self._max_depth:
+                _stack_over_limit(self, "Depth of tuples and semantic tags", self._max_depth)
+            self._frames.append((_FRAME_TUPLE, len(self.recognized_stack)))
 
         elif byte == tuple_end_b:
-            assert self.in_tuple
-            self.recognition_ended = True
+            if self._frames and self._frames[-1][0] == _FRAME_TUPLE:
+                self._close_tuple()
+            elif self.in_tuple and not self._frames:
+                self.recognition_ended = True
+            else:
+                raise FormatError("Unexpected } at %d in %s" % (self.stream_bytes_read, self.stream))
+
+        elif byte == bind_b:
+            self.__class__ = RecognitionStack_Bind
 
         else:
-            # TODO: add registers
-            raise TypeError("Expected a control byte, not %s at %d in %s" % (str(byte), self.stream_bytes_read, self.stream))
+            element = self.registers[byte[0]]
+            if element is None:
+                raise FormatError("Expected a control byte or a bound register, not %s at %d in %s" % (str(byte), self.stream_bytes_read, self.stream))
+            self.recognized_stack.append(element)
+            self._hits += 1
+
+    def _close_tuple(self):
+        start = self._frames.pop()[1]
+        element = UBF_Tuple(self.recognized_stack[start:])
+        del self.recognized_stack[start:]
+        self.recognized_stack.append(element)
+
+    def _close_tag(self):
+        start = self._frames.pop()[1]
+        if len(self.recognized_stack) - start != 1:
+            raise FormatError("Semantic tag must be 1 element, got %d at %d in %s" % (len(self.recognized_stack) - start, self.stream_bytes_read, self.stream))
+        element = self.recognized_stack.pop()
+        self.recognized_stack[-1] = tagged(self.recognized_stack[-1], element)
 
 RecognitionStack = RecognitionStack_None # allias for initial state
 
+def _stack_over_limit(stack, what: str, limit: int):
+    # a function, the states of the stack are not subclasses of RecognitionStack_None
+    raise LimitExceeded("%s over the limit of %d at %d in %s" % (what, limit, stack.stream_bytes_read, stack.stream))
+
+def _spill_stream(stream, length: int, chunk_size: int = 1 << 16) -> UBF_BinFile:
+    # the binary of the given length from the stream, copied into a temporary file
+    element = UBF_BinFile(tempfile.TemporaryFile(), length)
+    while length:
+        data = stream.read(min(length, chunk_size))
+        if not data:
+            element.close()
+            raise FormatError("Binary cut by end of stream, %d bytes missing" % length)
+        element.file.write(data)
+        length -= len(data)
+    element.file.seek(0)
+    return element
+
+class RecognitionStack_Bind:
+    def act(self, byte: bytes):
+        # bind the last element to the register byte, as ubf.Decoder._handleBind
+        if byte in reserved_b:
+            raise FormatError("Attempt to bind to reserved byte %s at %d in %s" % (str(byte), self.stream_bytes_read, self.stream))
+        if not self.recognized_stack:
+            raise FormatError("Nothing to bind to %s at %d in %s" % (str(byte), self.stream_bytes_read, self.stream))
+        if self._binds >= self._max_binds:
+            _stack_over_limit(self, "Binds", self._max_binds)
+        self.registers[byte[0]] = self.recognized_stack.pop()
+        self._binds += 1
+        self.__class__ = RecognitionStack_None
+
 class RecognitionStack_Int:
     def act(self, byte: bytes):
         if byte in int_b:
@@ -257,36 +678,1967 @@ class RecognitionStack_Int:
 class RecognitionStack_Str:
     def act(self, byte: bytes):
         if byte != stringquote:
-            # TODO: add escaping
+            self._quoted += 1
+            if self._quoted > self._max_string:
+                _stack_over_limit(self, "String", self._max_string)
+        if byte == backslash_b:
+            self.__class__ = RecognitionStack_StrEscape
+        elif byte != stringquote:
             self._pool += byte
         else:
             # finish the Str recognition
             # store Str element
             # return to None state
-            self.recognized_stack.append(UBF_Str(self._pool))
+            try:
+                content = self._pool.decode(text_encoding)
+            except UnicodeDecodeError:
+                raise FormatError("String is not %s text at %d in %s" % (text_encoding, self.stream_bytes_read, self.stream)) from None
+            self.recognized_stack.append(UBF_Str(content))
             self._pool = None
             self.__class__ = RecognitionStack_None
 
 class RecognitionStack_Const:
     def act(self, byte: bytes):
         if byte != constquote:
-            # TODO: add escaping
-            # TODO: should I check the length of constants?
+            self._quoted += 1
+            if self._quoted > self._max_string:
+                _stack_over_limit(self, "Constant", self._max_string)
+        if byte == backslash_b:
+            self.__class__ = RecognitionStack_ConstEscape
+        elif byte != constquote:
             # otherwise they are like str
             self._pool += byte
         else:
             # finish the Const recognition
             # store Const element
             # return to None state
-            self.recognized_stack.append(UBF_Const(self._pool))
+            try:
+                content = self._pool.decode(text_encoding)
+            except UnicodeDecodeError:
+                raise FormatError("Constant is not %s text at %d in %s" % (text_encoding, self.stream_bytes_read, self.stream)) from None
+            self.recognized_stack.append(UBF_Const(content))
             self._pool = None
             self.__class__ = RecognitionStack_None
 
+# only the quote and backslash are escaped, as in ubf.Decoder._collect_quoted
+
+class RecognitionStack_StrEscape:
+    def act(self, byte: bytes):
+        if byte not in (backslash_b, stringquote):
+            raise FormatError("Unsupported quoted character %s at %d in %s" % (str(byte), self.stream_bytes_read, self.stream))
+        self._quoted += 1
+        if self._quoted > self._max_string:
+            _stack_over_limit(self, "String", self._max_string)
+        self._pool += byte
+        self.__class__ = RecognitionStack_Str
+
+class RecognitionStack_ConstEscape:
+    def act(self, byte: bytes):
+        if byte not in (backslash_b, constquote):
+            raise FormatError("Unsupported quoted character %s at %d in %s" % (str(byte), self.stream_bytes_read, self.stream))
+        self._quoted += 1
+        if self._quoted > self._max_string:
+            _stack_over_limit(self, "Constant", self._max_string)
+        self._pool += byte
+        self.__class__ = RecognitionStack_Const
+
+# Buffered recognition
+#
+# The same grammar as the RecognitionStack states above,
+# but the stream is pulled in large chunks into a buffer
+# and whole runs of bytes (digits, whitespace, string bodies, binaries)
+# are scanned at once with precompiled regexes and slicing.
+# Nested tuples and semantic tags are kept as frames on the one stack
+# instead of spawning sub-recognizers.
+
+_K_REGISTER, _K_WS, _K_INT, _K_STR, _K_CONST, _K_COMMENT, _K_BIN, \
+    _K_TAG, _K_LIST, _K_APPEND, _K_OPEN, _K_CLOSE, _K_END, _K_BIND = range(14)
+
+def _byte_kinds():
+    kinds = bytearray(256)
+    for chars, kind in ((whitespace, _K_WS), (int_b + minus_b, _K_INT),
+                        (stringquote, _K_STR), (constquote, _K_CONST),
+                        (comment_b, _K_COMMENT), (tilde_b, _K_BIN),
+                        (semanticquote, _K_TAG), (list_b, _K_LIST),
+                        (append_b, _K_APPEND), (tuple_open_b, _K_OPEN),
+                        (tuple_end_b, _K_CLOSE), (end_b, _K_END),
+                        (bind_b, _K_BIND)):
+        for c in chars:
+            kinds[c] = kind
+    return bytes(kinds)
+
+_byte_kinds = _byte_kinds()
+
+# the common tokens in one match, after a run of whitespace:
+# integers, strings and constants without escapes;
+# any other byte is dispatched by _byte_kinds
+_token_re = re.compile(b"[" + re.escape(whitespace) + b"]*"
+                       b"(?:(-?[0-9]+)"
+                       b"|" + stringquote + b"([^" + stringquote + b"\\\\]*)" + stringquote +
+                       b"|" + constquote + b"([^" + constquote + b"\\\\]*)" + constquote +
+                       b"|([^" + re.escape(whitespace) + b"]))")
+_TOKEN_INT, _TOKEN_STR, _TOKEN_CONST, _TOKEN_OTHER = 1, 2, 3, 4
+# body of a quoted element: anything but the quote and backslash,
+# or a backslash-escaped quote or backslash (as ubf.Decoder._collect_quoted)
+_quoted_body_re = {q: re.compile(b"[^%s\\\\]*(?:\\\\[%s\\\\][^%s\\\\]*)*" % ((re.escape(bytes([q])),) * 3))
+                   for q in (stringquote + constquote + comment_b)}
+_unescape_re = re.compile(b"\\\\(.)", re.DOTALL)
+# the integers of a tuple or a list, for int_arrays:
+# runs of their bytes, and what is not valid in such a run,
+# kept to character classes, as a repeated group holds memory for each repeat
+_ws = b"[" + re.escape(whitespace) + b"]"
+_int_tuple_re = re.compile(b"[" + re.escape(whitespace) + b"0-9-]*")
+_int_list_re = re.compile(b"[" + re.escape(whitespace + append_b) + b"0-9-]*")
+_int_tuple_bad_re = re.compile(b"-(?![0-9])")
+# a list is valid if there is an integer between each two &
+# and as many integers as &, see _int_array
+_int_list_bad_re = re.compile(b"-(?![0-9])|&" + _ws + b"*&")
+_int_list_start_re = re.compile(_ws + b"*&")
+_int_re = re.compile(b"-?[0-9]+")
+
+def _int_array(cls, content: memoryview, count: int = None, step: int = 1 << 16):
+    # None if there are no integers, or not count of them, or they do not fit;
+    # parsed in steps, not to hold a bytes object for each of them
+    element = cls()
+    pos, n = 0, len(content)
+    try:
+        while pos < n:
+            end = min(pos + step, n)
+            while end < n and content[end] in int_b + minus_b:
+                end += 1
+            element.extend(map(int, _int_re.findall(content, pos, end)))
+            pos = end
+    except OverflowError:
+        return None
+    if not element or (count is not None and len(element) != count):
+        return None
+    return element
+
+class _ElementSink:
+    """
+    What _ScanningStack._scan_tokens does with the recognized tokens
+    for the recognition stacks: builds the elements on the stack.
+    """
+
+    make_int = UBF_Int
+    make_str = UBF_Str
+    make_const = UBF_Const
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.stack = owner.recognized_stack
+        self.push = self.stack.append
+
+    def binary_length(self):
+        stack = self.stack
+        if not stack or not isinstance(stack[-1], UBF_Int):
+            return None
+        return stack[-1]
+
+    def start_binary(self, length: int) -> bool:
+        # True if the binary is taken in pieces: copied to a file as the bytes come
+        spill_size = self.owner.spill_size
+        if spill_size is None or length <= spill_size:
+            return False
+        self.stack[-1] = UBF_BinFile(tempfile.TemporaryFile(), length)
+        return True
+
+    def binary_part(self, buf, start: int, end: int):
+        self.stack[-1].file.write(buf[start:end])
+
+    def end_binary(self):
+        self.stack[-1].file.seek(0)
+
+    def binary(self, buf, start: int, end: int):
+        self.stack[-1] = self.owner._binary(start, end)
+
+    def bind(self, register: int, at: int):
+        return self.stack.pop()
+
+    def start_list(self):
+        self.stack.append(UBF_List())
+
+    def append(self) -> bool:
+        # False if the element before the last one is not a list
+        stack = self.stack
+        if isinstance(stack[-2], list):
+            element = stack.pop()
+            stack[-1].append(element)
+            return True
+        if not isinstance(stack[-2], UBF_IntList):
+            return False
+        element = stack.pop()
+        if type(element) is UBF_Int and -1 << 63 <= element < 1 << 63:
+            stack[-1].append(element)
+            return True
+        # the list goes on as UBF_List
+        stack[-1] = UBF_List(stack[-1]) if stack[-1].semantic_tag is None else \
+                    tagged(UBF_List(stack[-1]), stack[-1].semantic_tag)
+        stack[-1].append(element)
+        return True
+
+    def start_tuple(self):
+        pass
+
+    def end_tuple(self, base: int):
+        stack = self.stack
+        element = UBF_Tuple(stack[base:])
+        del stack[base:]
+        stack.append(element)
+
+    def start_tag(self):
+        pass
+
+    def end_tag(self):
+        stack = self.stack
+        element = stack.pop()
+        stack[-1] = tagged(stack[-1], element)
+
+    def end_message(self):
+        # the element of the message
+        if len(self.stack) != 1:
+            raise FormatError("Message must be 1 element, got %d" % len(self.stack))
+        return self.stack.pop()
+
+class _ScanningStack:
+    """
+    The scanner shared by the buffered recognition stacks:
+    recognizes messages in self._buf from self._pos,
+    keeping the stack and the open tuples and tags between the scans.
+    The recognized tokens go to self._sink,
+    which builds the elements or, in EventRecognitionStack, emits events.
+    """
+
+    session = False # keep the registers from one message to the next
+    int_arrays = False # tuples and lists of integers only are UBF_IntTuple and UBF_IntList
+    stats = None # called with MessageStats of each message
+    spill_size = None # longer binaries are UBF_BinFile
+    limits = None # Limits of the messages
+
+    def _reset(self, buf: bytearray):
+        self._buf = buf
+        self._pos = 0       # where the scan continues in the buffer
+        self._partial = 0   # bytes of the token at self._pos already scanned
+        self._need = 0      # bytes known to be missing for the token at self._pos
+
+        self.stream_bytes_read = 0
+        self.recognized_stack = []
+        self._sink = _ElementSink(self)
+        self._frames = []   # (_FRAME_*, index of the first element of the frame in the stack of the sink)
+        self.registers = [None] * 256
+        self._bound = False # registers were bound in the current message
+        self._hits = self._binds = 0
+        self._seconds = 0.0 # in the earlier scans of the current message
+        self._binary_left = None # bytes of the binary in pieces still to come, 0 for its closing tilde
+
+    def _scan(self, final: bool, messages: list = None):
+        """_scan(self, final, messages = None)
+
+        Scans the buffer from self._pos until the end of a message.
+        Returns (element, bytes read) of the message,
+        or None if more bytes are needed.
+        If final -- the buffer holds the end of the stream.
+
+        With a messages list, the messages ended by $ are appended to it
+        and the scan goes on with the next one in the same call,
+        returning only the message ended by the end of stream.
+        """
+
+        return self._scan_tokens(final, messages)
+
+    def _scan_tokens(self, final: bool, messages: list = None):
+        # the scan of _scan, handing the tokens to self._sink;
+        # a sink that ends a message without an element scans on to the end of the buffer
+        sink = self._sink
+        buf = self._buf
+        n = len(buf)
+        pos = start = self._pos
+        stack = sink.stack
+        push = sink.push
+        append = sink.append
+        make_int, make_str, make_const = sink.make_int, sink.make_str, sink.make_const
+        frames = self._frames
+        registers = self.registers
+        kinds = _byte_kinds
+        match_token = _token_re.match
+        int_arrays = self.int_arrays
+        max_depth, max_bytes, max_binary, max_string, max_binds = \
+            _NO_BOUNDS if self.limits is None else self.limits._bounds()
+        # the message goes over max_bytes past this position
+        last = start + max_bytes - self.stream_bytes_read
+
+        partial = self._partial
+        self._partial = self._need = 0
+        if self.stats is not None:
+            self._started = time.perf_counter()
+
+        if self._binary_left is not None:
+            pos = self._binary_pieces(pos, final)
+            if self._binary_left is not None:
+                pos = n # all handed over, more is needed
+
+        while pos < n:
+            if pos > last:
+                self._over_limit("Message", max_bytes, pos - start)
+            if partial:
+                # resume the long quoted element, skipping the token regex
+                kind = kinds[buf[pos]]
+            else:
+                token = match_token(buf, pos)
+                if token is None:
+                    # only whitespace is left, the end of stream may still end the message
+                    pos = n
+                    continue
+
+                group = token.lastindex
+                if group == _TOKEN_INT:
+                    if token.end() == n and not final:
+                        break # more digits might follow
+                    push(make_int(token.group(group)))
+                    pos = token.end()
+                    continue
+                elif group == _TOKEN_STR:
+                    if token.end(group) - token.start(group) > max_string:
+                        self._over_limit("String", max_string, token.start(group) - start)
+                    try:
+                        push(make_str(token.group(group).decode(text_encoding)))
+                    except UnicodeDecodeError:
+                        raise _not_text("String", self.stream_bytes_read + token.start(group) - 1 - start) from None
+                    pos = token.end()
+                    continue
+                elif group == _TOKEN_CONST:
+                    if token.end(group) - token.start(group) > max_string:
+                        self._over_limit("Constant", max_string, token.start(group) - start)
+                    try:
+                        push(make_const(token.group(group).decode(text_encoding)))
+                    except UnicodeDecodeError:
+                        raise _not_text("Constant", self.stream_bytes_read + token.start(group) - 1 - start) from None
+                    pos = token.end()
+                    continue
+
+                pos = token.start(group)
+                kind = kinds[buf[pos]]
+
+            if kind == _K_REGISTER:
+                element = registers[buf[pos]]
+                if element is None:
+                    raise FormatError("Expected a control byte or a bound register, not %s at %d" % (bytes([buf[pos]]), self.stream_bytes_read + pos - start))
+                push(element)
+                self._hits += 1
+                pos += 1
+
+            elif kind == _K_INT:
+                # a minus not followed by digits
+                if pos + 1 == n and not final:
+                    break
+                raise FormatError("Expected digits after minus at %d" % (self.stream_bytes_read + pos - start))
+
+            elif kind in (_K_STR, _K_CONST, _K_COMMENT):
+                quote = buf[pos]
+                end = _quoted_body_re[quote].match(buf, pos + 1 + partial).end()
+                partial = 0
+                if end - pos - 1 > max_string:
+                    # the content so far, the rest is not waited for
+                    self._over_limit(("String", "Constant", "Comment")[kind - _K_STR], max_string, pos - start)
+                if end + 1 >= n and (end == n or buf[end] != quote):
+                    # no closing quote yet, or a backslash at the end of the buffer
+                    if final:
+                        raise FormatError("Unterminated %s at %d" % (chr(quote), self.stream_bytes_read + pos - start))
+                    self._partial = end - pos - 1
+                    break
+                if buf[end] != quote:
+                    raise FormatError("Unsupported quoted character %s at %d" % (chr(buf[end + 1]), self.stream_bytes_read + end - start))
+
+                if kind != _K_COMMENT:
+                    content = bytes(buf[pos + 1:end])
+                    if backslash_b in content:
+                        content = _unescape_re.sub(b"\\1", content)
+                    try:
+                        content = content.decode(text_encoding)
+                    except UnicodeDecodeError:
+                        raise _not_text(("String", "Constant")[kind - _K_STR], self.stream_bytes_read + pos - start) from None
+                    push(make_str(content) if kind == _K_STR else make_const(content))
+                pos = end + 1
+
+            elif kind == _K_BIN:
+                length = sink.binary_length()
+                if length is None:
+                    raise FormatError("Binary must be preceded by its length at %d" % (self.stream_bytes_read + pos - start))
+                if length < 0:
+                    raise FormatError("Negative binary length %d at %d" % (length, self.stream_bytes_read + pos - start))
+                if length > max_binary:
+                    self._over_limit("Binary of length %d" % length, max_binary, pos - start)
+                if pos + 1 + length > last:
+                    self._over_limit("Message", max_bytes, pos - start)
+                if sink.start_binary(length):
+                    # handed over as the bytes come, in the following scans if needed
+                    self._binary_left = length
+                    pos = self._binary_pieces(pos + 1, final)
+                    if self._binary_left is not None:
+                        break
+                    continue
+                end = pos + 1 + length
+                # wait for the byte after the binary, it may be the closing tilde
+                if end >= n and not final:
+                    self._need = end + 1 - n
+                    break
+                if end > n:
+                    raise FormatError("Binary of length %d cut by end of stream" % length)
+                sink.binary(buf, pos + 1, end)
+                pos = end
+                if pos < n and buf[pos] == tilde_b[0]:
+                    pos += 1
+
+            elif kind == _K_APPEND:
+                base = frames[-1][1] if frames else 0
+                if len(stack) - base < 2 or not append():
+                    raise FormatError("Append & without a list and element at %d" % (self.stream_bytes_read + pos - start))
+                pos += 1
+
+            elif kind == _K_LIST:
+                if int_arrays:
+                    end = _int_list_re.match(buf, pos + (partial or 1)).end()
+                    partial = 0
+                    if end > last:
+                        self._over_limit("Message", max_bytes, pos - start)
+                    if end == n and not final:
+                        # the list may go on
+                        self._partial = n - pos
+                        self._need = n - pos
+                        break
+                    while end > pos + 1 and buf[end - 1] != append_b[0]:
+                        end -= 1
+                    if end > pos + 1 and not _int_list_start_re.match(buf, pos + 1, end) \
+                            and not _int_list_bad_re.search(buf, pos + 1, end):
+                        element = _int_array(UBF_IntList, buf[pos + 1:end], bytes(buf[pos + 1:end]).count(append_b))
+                        if element is not None:
+                            push(element)
+                            pos = end
+                            continue
+                sink.start_list()
+                pos += 1
+
+            elif kind == _K_OPEN:
+                if len(frames) >= max_depth:
+                    self._over_limit("Depth of tuples and semantic tags", max_depth, pos - start)
+                if int_arrays:
+                    end = _int_tuple_re.match(buf, pos + (partial or 1)).end()
+                    partial = 0
+                    if end > last:
+                        self._over_limit("Message", max_bytes, pos - start)
+                    if end == n and not final:
+                        # the tuple may go on
+                        self._partial = n - pos
+                        self._need = n - pos
+                        break
+                    if end < n and buf[end] == tuple_end_b[0] and not _int_tuple_bad_re.search(buf, pos + 1, end):
+                        element = _int_array(UBF_IntTuple, buf[pos + 1:end])
+                        if element is not None:
+                            push(element)
+                            pos = end + 1
+                            continue
+                sink.start_tuple()
+                frames.append((_FRAME_TUPLE, len(stack)))
+                pos += 1
+
+            elif kind == _K_CLOSE:
+                if not frames or frames[-1][0] != _FRAME_TUPLE:
+                    raise FormatError("Unexpected tuple end at %d" % (self.stream_bytes_read + pos - start))
+                sink.end_tuple(frames.pop()[1])
+                pos += 1
+
+            elif kind == _K_TAG or (kind == _K_END and frames and frames[-1][0] == _FRAME_TAG):
+                # the end of message closes a semantic tag too, like in RecognitionStack
+                if frames and frames[-1][0] == _FRAME_TAG:
+                    base = frames.pop()[1]
+                    if len(stack) - base != 1:
+                        raise FormatError("Semantic tag must be 1 element, got %d at %d" % (len(stack) - base, self.stream_bytes_read + pos - start))
+                    sink.end_tag()
+                else:
+                    if len(stack) <= (frames[-1][1] if frames else 0):
+                        raise FormatError("Semantic tag must follow an element at %d" % (self.stream_bytes_read + pos - start))
+                    if len(frames) >= max_depth:
+                        self._over_limit("Depth of tuples and semantic tags", max_depth, pos - start)
+                    sink.start_tag()
+                    frames.append((_FRAME_TAG, len(stack)))
+                pos += 1
+
+            elif kind == _K_END:
+                if frames:
+                    raise FormatError("Did not expect end of message $ inside tuple at %d" % (self.stream_bytes_read + pos - start))
+                pos += 1
+                if pos > last:
+                    self._over_limit("Message", max_bytes, pos - start)
+                out = self._finish_message(pos - start)
+                if out is not None:
+                    if messages is None:
+                        return out
+                    messages.append(out[0])
+                start = pos
+                last = start + max_bytes
+                registers = self.registers
+                if self.stats is not None:
+                    self._started = time.perf_counter()
+
+            elif kind == _K_BIND:
+                # bind the last element to the next byte, as ubf.Decoder._handleBind
+                if pos + 1 == n:
+                    if not final:
+                        break
+                    raise FormatError("Stream ended before the register of > at %d" % (self.stream_bytes_read + pos - start))
+                register = buf[pos + 1]
+                if kinds[register] != _K_REGISTER:
+                    raise FormatError("Attempt to bind to reserved byte %s at %d" % (bytes([register]), self.stream_bytes_read + pos - start))
+                if len(stack) <= (frames[-1][1] if frames else 0):
+                    raise FormatError("Nothing to bind to %s at %d" % (bytes([register]), self.stream_bytes_read + pos - start))
+                element = sink.bind(register, self.stream_bytes_read + pos - start)
+                if self._binds >= max_binds:
+                    self._over_limit("Binds", max_binds, pos - start)
+                registers[register] = element
+                self._bound = True
+                self._binds += 1
+                pos += 2
+
+        else:
+            if final:
+                if frames:
+                    raise FormatError("Stream ended inside a tuple or semantic tag")
+                if stack:
+                    # end of stream is the end of the message, like in RecognitionStack
+                    if pos > last:
+                        self._over_limit("Message", max_bytes, pos - start)
+                    out = self._finish_message(pos - start)
+                    if out is not None:
+                        return out
+                    start = pos
+
+        self.stream_bytes_read += pos - start
+        self._pos = pos
+        if self.stream_bytes_read + n - pos > max_bytes:
+            # with the partial token, before more is buffered
+            self._over_limit("Message", max_bytes, n - pos)
+        if self.stats is not None:
+            self._seconds += time.perf_counter() - self._started
+        return None
+
+    def _over_limit(self, what: str, limit: int, at: int):
+        # at -- from the start of the scan
+        raise LimitExceeded("%s over the limit of %d at %d" % (what, limit, self.stream_bytes_read + at))
+
+    def _binary_pieces(self, pos: int, final: bool) -> int:
+        # hands the bytes of the binary in pieces from the buffer to the sink,
+        # returns the position after them and the closing tilde
+        buf = self._buf
+        n = len(buf)
+        if self._binary_left:
+            end = min(n, pos + self._binary_left)
+            if end > pos:
+                self._sink.binary_part(buf, pos, end)
+                self._binary_left -= end - pos
+                pos = end
+            if self._binary_left:
+                if final:
+                    raise FormatError("Binary cut by end of stream, %d bytes missing" % self._binary_left)
+                return pos
+            self._sink.end_binary()
+
+        if pos < n:
+            if buf[pos] == tilde_b[0]:
+                pos += 1
+            self._binary_left = None
+        elif final:
+            self._binary_left = None
+        return pos
+
+    def _finish_message(self, scanned):
+        # (element, bytes) of the message, None if the sink builds no element
+        element = self._sink.end_message()
+        out = None if element is None else (element, self.stream_bytes_read + scanned)
+        self._pos += scanned
+        self.stream_bytes_read = 0
+        if self.stats is not None:
+            counts, depth = _element_counts(out[0])
+            self.stats(MessageStats("decode", out[1], counts, depth, self._hits, self._binds,
+                                    self._seconds + time.perf_counter() - self._started))
+            self._seconds = 0.0
+        self._hits = self._binds = 0
+        if self._bound and not self.session:
+            # registers are bound per message, as in ubf.Decoder
+            self.registers = [None] * 256
+            self._bound = False
+        return out
+
+    def _binary(self, start: int, end: int):
+        # one copy, straight from the buffer
+        with memoryview(self._buf) as view:
+            return UBF_Bin(view[start:end])
+
+
+class IncrementalRecognitionStack(_ScanningStack):
+    """
+    Recognizes UBF messages from bytes pushed with feed(data),
+    without reading any stream itself.
+
+    Partial tokens, the stack and the open tuples are kept between feed calls,
+    so the data may be cut anywhere.
+
+    With int_arrays the tuples and lists of integers only
+    are recognized at once into UBF_IntTuple and UBF_IntList arrays.
+    stats is called with the MessageStats of each message.
+    The binaries longer than spill_size are copied into temporary files
+    as their bytes come, and recognized as UBF_BinFile.
+    A message over the Limits given as limits raises LimitExceeded.
+    """
+
+    def __init__(self, session: bool = False, int_arrays: bool = False, stats = None, spill_size: int = None, limits: Limits = None):
+        self.session = session
+        self.int_arrays = int_arrays
+        self.stats = stats
+        self.spill_size = spill_size
+        self.limits = limits
+        self._reset(bytearray())
+
+    def feed(self, data: bytes):
+        """feed(self, data)
+
+        Adds data to the buffer.
+        Returns the list of messages completed by it.
+        """
+
+        self._append(data)
+        messages = []
+        self._scan(False, messages)
+        return messages
+
+    def close(self):
+        """close(self)
+
+        Marks the end of data,
+        the last message may end without $ as in RecognitionStack.
+        Returns the list of remaining messages.
+        Raises FormatError if the data ends inside an element.
+        """
+
+        messages = []
+        out = self._scan(True, messages)
+        if out is not None:
+            messages.append(out[0])
+        return messages
+
+    def _append(self, data):
+        if self._pos:
+            # drop the scanned bytes, only a partial token is left
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += data
+
+class BufferedRecognitionStack(IncrementalRecognitionStack):
+    """
+    Recognizes UBF messages from a stream read in chunks of chunk_size bytes.
+
+    Returns the same UBF elements as RecognitionStack,
+    but scans runs of bytes at once instead of acting on each byte.
+    The stream is read ahead past the end of a message,
+    the rest is kept in the buffer for the following recognize calls.
+    """
+
+    def __init__(self, stream: "byte_stream" = None, chunk_size: int = 1 << 16, session: bool = False, int_arrays: bool = False, stats = None, spill_size: int = None, limits: Limits = None):
+        self.chunk_size = chunk_size
+        self.session = session
+        self.int_arrays = int_arrays
+        self.stats = stats
+        self.spill_size = spill_size
+        self.limits = limits
+        self._set_stream(stream)
+
+    def _set_stream(self, stream):
+        if isinstance(stream, (bytes, bytearray)):
+            self.stream = None
+            self._reset(bytearray(stream))
+            self._eof = True
+        else:
+            self.stream = stream
+            self._reset(bytearray())
+            self._eof = stream is None
+
+    def recognize(self, stream: "byte_stream" = None):
+        """recognize(self, stream = None)
+
+        Recognizes a full message from the given stream.
+        If None stream is given -- continues on self.stream.
+
+        Message end = b'$' or end of stream.
+        Raises EndOfStream if the stream ends before any element.
+
+        Returns the element and the number of bytes of the message,
+        as RecognitionStack.recognize.
+        """
+
+        if stream is not None:
+            self._set_stream(stream)
+
+        while True:
+            out = self._scan(self._eof)
+            if out is not None:
+                return out
+            if self._eof:
+                raise EndOfStream("No UBF message before end of stream %s" % self.stream)
 
-test_UBF_bytestreams = [ b'"foo" `{124 "bar" `4~ab01~`}`' ]
+            data = self.stream.read(max(self.chunk_size, self._need))
+            if data:
+                self._append(data)
+            else:
+                self._eof = True
+
+class MappedRecognitionStack(_ScanningStack):
+    """
+    Recognizes UBF messages in a whole buffer:
+    an mmap, bytes or anything else exporting the buffer interface.
+
+    The buffer is not copied.
+    Binaries are returned as memoryview slices of the buffer,
+    except the ones with a semantic tag, which become UBF_Bin.
+    The slices can be wrapped without a copy, as numpy.frombuffer(element, dtype).
+    int_arrays, stats and limits as in IncrementalRecognitionStack.
+    """
+
+    def __init__(self, source, session: bool = False, int_arrays: bool = False, stats = None, limits: Limits = None):
+        self.source = source
+        self.session = session
+        self.int_arrays = int_arrays
+        self.stats = stats
+        self.limits = limits
+        self._reset(memoryview(source).cast("B"))
+
+    @classmethod
+    def from_file(cls, path: str, int_arrays: bool = False, stats = None, limits: Limits = None):
+        """from_file(cls, path, int_arrays = False, stats = None, limits = None)
+
+        Maps the file read-only.
+        The mapping stays open while any of the binaries recognized from it is alive.
+        """
+
+        with open(path, "rb") as f:
+            try:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                source = b""
+        return cls(source, int_arrays=int_arrays, stats=stats, limits=limits)
+
+    def recognize(self):
+        """recognize(self)
+
+        Recognizes the next message in the buffer.
+        Returns the element and the number of bytes of the message.
+        Raises EndOfStream at the end of the buffer.
+        """
+
+        out = self._scan(True)
+        if out is None:
+            raise EndOfStream("No UBF message before end of buffer")
+        return out
+
+    def __iter__(self):
+        out = self._scan(True)
+        while out is not None:
+            yield out[0]
+            out = self._scan(True)
+
+    def _binary(self, start: int, end: int):
+        return self._buf[start:end]
+
+
+# Bulk decoding
+#
+# All the complete messages of a buffer or a stream in one call,
+# each message scanned on in the same _scan as the one before.
+
+def decode_many(buffer, session: bool = False, int_arrays: bool = False, limits: Limits = None) -> tuple:
+    """decode_many(buffer, session = False, int_arrays = False, limits = None)
+
+    Recognizes all the messages ended by $ in the buffer.
+    Returns (messages, offset): the list of the elements
+    and the offset where the unfinished rest of the buffer starts,
+    after the last $ (len(buffer) when the buffer ends with a message).
+    buffer[offset:] is to be decoded again with the bytes that follow it.
+    """
+
+    return _decode_chunks((buffer,), session, int_arrays, limits)
+
+def decode_all(stream: "byte_stream", chunk_size: int = 1 << 16, session: bool = False, int_arrays: bool = False, limits: Limits = None) -> tuple:
+    """decode_all(stream, chunk_size = 1 << 16, session = False, int_arrays = False, limits = None)
+
+    Reads the stream to its end in chunks of chunk_size bytes
+    and recognizes all the messages ended by $, as decode_many.
+    The offset counts the bytes read from the stream.
+    """
+
+    return _decode_chunks(iter(lambda: stream.read(chunk_size), b""), session, int_arrays, limits)
+
+def _decode_chunks(chunks, session: bool, int_arrays: bool, limits: Limits) -> tuple:
+    parser = IncrementalRecognitionStack(session, int_arrays, limits=limits)
+    messages = []
+    read = 0
+    for data in chunks:
+        read += len(data)
+        parser._append(data)
+        parser._scan(False, messages)
+    # the bytes not scanned yet and the ones of the unfinished message
+    return messages, read - (len(parser._buf) - parser._pos) - parser.stream_bytes_read
+
+
+# Events
+#
+# The messages as a stream of (event, value) pairs instead of elements,
+# recognized by the scanner of _ScanningStack with an _EventSink.
+
+# kinds of the elements on the event stack
+_E_ATOM, _E_LIST, _E_OTHER = 0, 1, 2
+
+class _EventSink:
+    """
+    What _ScanningStack._scan_tokens does with the recognized tokens
+    for EventRecognitionStack: appends the events to self.events.
+    The stack holds the _E_* kinds of the elements, the registers hold events.
+    """
+
+    def __init__(self, part_size: int):
+        self.part_size = part_size # longer binaries are in pieces
+        self.stack = bytearray()
+        self.pending = None # the last atom, held until the next token shows it is not bound
+        self.events = []
+
+    @staticmethod
+    def make_int(digits):
+        return ("int", int(digits))
+
+    @staticmethod
+    def make_str(content):
+        return ("string", content)
+
+    @staticmethod
+    def make_const(content):
+        return ("symbol", content)
+
+    def push(self, event):
+        if self.pending is not None:
+            self.events.append(self.pending)
+        self.pending = event
+        self.stack.append(_E_ATOM)
+
+    def flush(self):
+        # the structure comes after the held atom
+        if self.pending is not None:
+            self.events.append(self.pending)
+            self.pending = None
+
+    def binary_length(self):
+        if self.pending is None or self.pending[0] != "int":
+            return None
+        return self.pending[1]
+
+    def start_binary(self, length: int) -> bool:
+        if length <= self.part_size:
+            return False
+        # the length is not an element any more
+        self.pending = None
+        self.stack[-1] = _E_OTHER
+        self.events.append(("start_binary", length))
+        return True
+
+    def binary_part(self, buf, start: int, end: int):
+        self.events.append(("binary_part", bytes(buf[start:end])))
+
+    def end_binary(self):
+        self.events.append(("end_binary", None))
+
+    def binary(self, buf, start: int, end: int):
+        self.pending = ("binary", bytes(buf[start:end]))
+
+    def bind(self, register: int, at: int):
+        if self.pending is None:
+            raise FormatError("Events can not bind a tuple, list, tagged element or binary in pieces to %s at %d" % (bytes([register]), at))
+        event, self.pending = self.pending, None
+        self.stack.pop()
+        return event
+
+    def start_list(self):
+        self.flush()
+        self.stack.append(_E_LIST)
+        self.events.append(("start_list", None))
+
+    def append(self) -> bool:
+        self.flush()
+        if self.stack[-2] != _E_LIST:
+            return False
+        self.stack.pop()
+        self.events.append(("append", None))
+        return True
+
+    def start_tuple(self):
+        self.flush()
+        self.events.append(("start_tuple", None))
+
+    def end_tuple(self, base: int):
+        self.flush()
+        del self.stack[base:]
+        self.stack.append(_E_OTHER)
+        self.events.append(("end_tuple", None))
+
+    def start_tag(self):
+        self.flush()
+        self.events.append(("start_tag", None))
+
+    def end_tag(self):
+        self.flush()
+        self.stack.pop()
+        if self.stack[-1] == _E_ATOM:
+            self.stack[-1] = _E_OTHER
+        self.events.append(("end_tag", None))
+
+    def end_message(self):
+        # None, the scan goes on with the next message
+        self.flush()
+        if len(self.stack) != 1:
+            raise FormatError("Message must be 1 element, got %d" % len(self.stack))
+        self.stack.clear()
+        self.events.append(("end_message", None))
+        return None
+
+class EventRecognitionStack(IncrementalRecognitionStack):
+    """
+    Recognizes UBF messages from bytes pushed with feed(data) into events,
+    without building the elements,
+    so a message of any size is read in the memory of one byte
+    per element of its open tuples:
+
+        ("int", int), ("string", str), ("symbol", str), ("binary", bytes)
+        ("start_binary", length), ("binary_part", bytes), ..., ("end_binary", None)
+                                -- a binary longer than binary_part, in pieces
+        ("start_tuple", None), ("end_tuple", None)
+        ("start_list", None)    -- an empty list
+        ("append", None)        -- the last element is appended to the list before it
+        ("start_tag", None), ("end_tag", None)
+                                -- the element between them is the semantic tag of the one before
+        ("end_message", None)
+
+    The events follow the recognition stack,
+    lists are built with append as with & in the message.
+    A bound atom is replayed where it is read from its register.
+    Binding a tuple, a list, a tagged element or a binary in pieces
+    would need the whole element, and raises FormatError.
+    A message over the Limits given as limits raises LimitExceeded,
+    the binaries in pieces count against max_binary as a whole.
+    """
+
+    def __init__(self, session: bool = False, binary_part: int = 1 << 16, limits: Limits = None):
+        self.session = session
+        self.binary_part = binary_part
+        self.limits = limits
+        self._reset(bytearray())
+
+    def _reset(self, buf: bytearray):
+        _ScanningStack._reset(self, buf)
+        self._sink = _EventSink(self.binary_part)
+
+    def feed(self, data: bytes):
+        """feed(self, data)
+
+        Adds data to the buffer.
+        Returns the list of events completed by it.
+        """
+
+        self._append(data)
+        return self._scan_events(False)
+
+    def close(self):
+        """close(self)
+
+        Marks the end of data,
+        the last message may end without $ as in RecognitionStack.
+        Returns the list of remaining events.
+        """
+
+        return self._scan_events(True)
+
+    def _scan_events(self, final: bool):
+        events = self._sink.events = []
+        self._scan_tokens(final)
+        return events
+
+def iter_events(source, chunk_size: int = 1 << 16, session: bool = False, binary_part: int = 1 << 16, limits: Limits = None):
+    """iter_events(source, chunk_size = 1 << 16, session = False, binary_part = 1 << 16, limits = None)
+
+    Generator of the events of EventRecognitionStack,
+    from a stream read in chunks of chunk_size bytes, or from bytes.
+    """
+
+    stack = EventRecognitionStack(session, binary_part, limits)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        with memoryview(source) as view:
+            for i in range(0, len(view), chunk_size):
+                yield from stack.feed(view[i:i + chunk_size])
+    else:
+        for data in iter(lambda: source.read(chunk_size), b""):
+            yield from stack.feed(data)
+    yield from stack.close()
+
+def build_from_events(events):
+    """build_from_events(events)
+
+    Builds the UBF elements back from the events,
+    a generator of the messages.
+    """
+
+    stack = []
+    frames = []
+    binary = None
+    for event, value in events:
+        if event == "int":
+            stack.append(UBF_Int(value))
+        elif event == "string":
+            stack.append(UBF_Str(value))
+        elif event == "symbol":
+            stack.append(UBF_Const(value))
+        elif event == "binary":
+            stack.append(UBF_Bin(value))
+        elif event == "start_binary":
+            binary = bytearray()
+        elif event == "binary_part":
+            binary += value
+        elif event == "end_binary":
+            stack.append(UBF_Bin(binary))
+            binary = None
+        elif event == "start_list":
+            stack.append(UBF_List())
+        elif event == "append":
+            element = stack.pop()
+            stack[-1].append(element)
+        elif event in ("start_tuple", "start_tag"):
+            frames.append(len(stack))
+        elif event == "end_tuple":
+            start = frames.pop()
+            element = UBF_Tuple(stack[start:])
+            del stack[start:]
+            stack.append(element)
+        elif event == "end_tag":
+            frames.pop()
+            tag = stack.pop()
+            stack[-1] = tagged(stack[-1], tag)
+        elif event == "end_message":
+            yield stack.pop()
+
+
+# Message boundaries
+#
+# Finds where the messages end without building the elements:
+# only quotes, comments, binaries and tags can hide or change a $,
+# the quoted elements are skipped by the regex.
+# A binary is skipped by the digits of its length in front of the ~,
+# if the length is not written there (a register, a tag)
+# the message is recognized in full to find its end.
+
+def _boundary_regex(specials: bytes, flat_tuples: bool = False):
+    # runs of other bytes and whole quoted elements,
+    # up to a special byte or a quote which does not close (cut or bad escape);
+    # with flat_tuples the tuples holding only such runs are skipped too
+    quotes = stringquote + constquote + comment_b
+    stop = b"[^" + re.escape(quotes + specials) + b"]*"
+    quoted = b"|".join(re.escape(bytes([q])) + _quoted_body_re[q].pattern + re.escape(bytes([q])) for q in quotes)
+    run = stop + b"(?:(?:" + quoted + b")" + stop + b")*"
+    if flat_tuples:
+        run = run + b"(?:" + re.escape(tuple_open_b) + run + re.escape(tuple_end_b) + run + b")*"
+    return re.compile(run + b"([" + re.escape(quotes + specials) + b"])")
+
+# tuples matter only inside tags, where a ` opens a nested tag
+_boundary_re, _tag_boundary_re = (_boundary_regex(tilde_b + end_b + semanticquote),
+                                  _boundary_regex(tilde_b + end_b + semanticquote + tuple_open_b + tuple_end_b))
+
+def message_ends(buffer, pos: int = 0):
+    """message_ends(buffer, pos = 0)
+
+    Generates the offsets just past the $ of the messages in the buffer,
+    starting with the message at pos.
+    Stops at the end of the buffer, a message cut by the end is not counted.
+    The rest of the errors are left to the recognizers.
+    """
+
+    buf = memoryview(buffer).cast("B")
+    n = len(buf)
+    start = pos   # of the current message
+    floor = pos   # the length of a binary is not looked for before floor
+    frames = []
+    while True:
+        match = (_tag_boundary_re if frames else _boundary_re).match(buf, pos)
+        if match is None:
+            return
+        pos = match.start(1)
+        byte = buf[pos]
+
+        if byte in (stringquote[0], constquote[0], comment_b[0]):
+            end = _quoted_body_re[byte].match(buf, pos + 1).end()
+            if end + 1 >= n or buf[end] == byte:
+                # cut by the end of the buffer,
+                # or the last quoted element, with no special byte after it
+                return
+            raise FormatError("Unsupported quoted character %s at %d" % (chr(buf[end + 1]), end))
+
+        elif byte == tilde_b[0]:
+            span = _binary_span(buf, pos, floor)
+            if span is None:
+                # the length is not written in front, recognize the message
+                end = _recognized_end(buf, start)
+                if end is None:
+                    return
+                yield end
+                pos = start = floor = end
+                frames = []
+                continue
+            end = span[1]
+            if end > n:
+                return
+            pos = floor = end
+
+        elif byte == semanticquote[0]:
+            if frames and frames[-1] == _FRAME_TAG:
+                frames.pop()
+            else:
+                frames.append(_FRAME_TAG)
+            pos += 1
+
+        elif byte == tuple_open_b[0]:
+            frames.append(_FRAME_TUPLE)
+            pos += 1
+
+        elif byte == tuple_end_b[0]:
+            if frames.pop() != _FRAME_TUPLE:
+                raise FormatError("Unexpected } at %d" % pos)
+            pos += 1
+
+        else: # end of message
+            pos += 1
+            if frames:
+                if frames[-1] != _FRAME_TAG:
+                    raise FormatError("Did not expect end of message $ inside tuple at %d" % (pos - 1))
+                # $ closes the tag as in the recognizers
+                frames.pop()
+                continue
+            yield pos
+            start = floor = pos
+
+def _binary_span(buf: memoryview, pos: int, floor: int):
+    # (start of the length, end) of the binary with the ~ at pos,
+    # the end after the closing ~ if any, past the end of the buffer if cut;
+    # None if its length is not written in digits in front, after floor
+    digits_end = pos
+    while digits_end > floor and buf[digits_end - 1] in whitespace:
+        digits_end -= 1
+    digits = digits_end
+    while digits > floor and buf[digits - 1] in int_b:
+        digits -= 1
+    if digits == digits_end or (digits > floor and buf[digits - 1] == minus_b[0]):
+        return None
+    end = pos + 1 + int(bytes(buf[digits:digits_end]))
+    if end < len(buf) and buf[end] == tilde_b[0]:
+        end += 1
+    return digits, end
+
+def _recognized_end(buf: memoryview, start: int):
+    # not final: a message cut by the end of the buffer is not finished
+    out = MappedRecognitionStack(buf[start:])._scan(False)
+    if out is None:
+        return None
+    return start + out[1]
+
+class MessageIndex:
+    """
+    Random access to a file of concatenated UBF messages.
+
+    The offsets of the message ends are kept in index_path
+    (path + ".idx" by default) as an array of 64-bit integers,
+    only the file appended since is scanned when it is opened again.
+    The index starts with the CRC-32 of the first and of the last
+    check_size bytes indexed: a file whose indexed bytes changed
+    is taken as rewritten and indexed again.
+    The messages are recognized one by one,
+    so the file must not be written in session mode.
+    """
+
+    check_size = 4096
+
+    def __init__(self, path: str, index_path: str = None):
+        self.path = path
+        self.index_path = index_path or path + ".idx"
+        self.ends = array.array("q")
+        self._checks = None
+        self._map = b""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                self.ends.frombytes(f.read())
+            self._checks = tuple(self.ends[:2])
+            del self.ends[:2]
+        self.update()
+
+    def _crcs(self, end: int) -> tuple:
+        # of the first and last check_size bytes before end
+        with memoryview(self._map) as view:
+            return (zlib.crc32(view[:min(end, self.check_size)]),
+                    zlib.crc32(view[max(0, end - self.check_size):end]))
+
+    def update(self) -> int:
+        """update(self)
+
+        Indexes the messages appended to the file.
+        Returns the number of the new messages.
+        """
+
+        self.close()
+        with open(self.path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                self._map = b""
+
+        end = self.ends[-1] if self.ends else 0
+        if self._checks is None or end > len(self._map) or self._crcs(end) != self._checks:
+            # new, or the file was rewritten
+            self.ends = array.array("q")
+            self._checks = None
+            end = 0
+        known = len(self.ends)
+        self.ends.extend(message_ends(self._map, end))
+        if self._checks is None or len(self.ends) > known:
+            self._checks = self._crcs(self.ends[-1] if self.ends else 0)
+            with open(self.index_path, "r+b" if known else "wb") as f:
+                array.array("q", self._checks).tofile(f)
+                f.seek(0, os.SEEK_END)
+                self.ends[known:].tofile(f)
+        return len(self.ends) - known
+
+    def close(self):
+        """close(self)
+
+        Unmaps the file, the index is opened again by update.
+        """
+
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                # binaries of the messages still point into the map, it goes with them
+                pass
+        self._map = b""
+
+    def __len__(self):
+        return len(self.ends)
+
+    def span(self, i: int):
+        """span(self, i)
+
+        Returns (start, end) offsets of the message i in the file.
+        """
+
+        i = range(len(self.ends))[i]
+        return (self.ends[i - 1] if i else 0), self.ends[i]
+
+    def __getitem__(self, i: int):
+        start, end = self.span(i)
+        return MappedRecognitionStack(memoryview(self._map)[start:end]).recognize()[0]
+
+    def messages(self, i: int = 0):
+        """messages(self, i = 0)
+
+        Generates the messages from the message i on.
+        """
+
+        start = self.span(i)[0] if self.ends else 0
+        end = self.ends[-1] if self.ends else 0
+        return iter(MappedRecognitionStack(memoryview(self._map)[start:end]))
+
+
+# Parallel decoding
+
+def _decode_span(path: str, start: int, end: int, function = None) -> list:
+    # in a worker process: the bytes are read here, not sent over the pipe
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    stack = BufferedRecognitionStack(data)
+    messages = []
+    while True:
+        try:
+            element = stack.recognize()[0]
+        except EndOfStream:
+            return messages
+        messages.append(element if function is None else function(element))
+
+def decode_parallel(path: str, processes: int = None, chunk_size: int = 1 << 22, index: MessageIndex = None, function = None):
+    """decode_parallel(path, processes = None, chunk_size = 1 << 22, index = None, function = None)
+
+    Generates the messages of the file in their order,
+    decoded in a pool of processes (os.cpu_count() by default).
+    If a function is given, generates function(message) instead,
+    called in the workers: the messages are sent back pickled,
+    which costs about half as much as decoding them,
+    the smaller results of the function are cheaper.
+
+    The file is split at message ends into chunks of about chunk_size bytes,
+    the workers get the offsets of a chunk and read it themselves.
+    At most 2 chunks per process are decoded ahead of the one being yielded.
+    The ends are taken from the index if given,
+    otherwise they are scanned with message_ends as the chunks are needed.
+    The messages are decoded one by one, not in session mode.
+    """
+
+    size = os.path.getsize(path)
+    if index is not None:
+        ends = iter(index.ends)
+        source = None
+    else:
+        with open(path, "rb") as f:
+            try:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                source = b""
+        ends = message_ends(source)
+
+    def spans():
+        start = 0
+        for end in ends:
+            if end - start >= chunk_size:
+                yield start, end
+                start = end
+        if start < size:
+            # the rest, may be a message ended by the end of file
+            yield start, size
+
+    processes = processes or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        ahead = 2 * processes
+        pending = collections.deque()
+        for start, end in spans():
+            pending.append(pool.submit(_decode_span, path, start, end, function))
+            if len(pending) > ahead:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# Path decoding
+#
+# Decodes one subterm of a message.
+# The elements of the tuples on the path are delimited by their bytes,
+# the other tuples, tags and binaries are skipped without building them.
+# The registers bound on the way are logged as (position of >, register, span of the element),
+# and the ones live at the start of the subterm are decoded with it.
+# A message the skipping does not follow (errors included) is decoded in full,
+# but the errors inside the skipped elements are not looked for.
+
+class _FullDecode(Exception):
+    pass
+
+_skip_re = _boundary_regex(tilde_b + end_b + semanticquote + tuple_open_b + tuple_end_b + bind_b, True)
+
+def _bound_span(bindings: list, register: int):
+    for pos, bound, span in reversed(bindings):
+        if bound == register:
+            return span
+    raise _FullDecode()
+
+def _last_atom(buf: memoryview, pos: int, end: int, bindings: list):
+    # the span of the last element between pos and end,
+    # which hold no tuples, tags or binaries
+    last = None
+    while True:
+        token = _token_re.match(buf, pos, end)
+        if token is None:
+            break
+        group = token.lastindex
+        if group != _TOKEN_OTHER:
+            last = token.start(group) - (group != _TOKEN_INT), token.end()
+            pos = token.end()
+            continue
+        pos = token.start(group)
+        kind = _byte_kinds[buf[pos]]
+        if kind in (_K_STR, _K_CONST, _K_COMMENT):
+            quoted = _quoted_body_re[buf[pos]].match(buf, pos + 1, end).end() + 1
+            if kind != _K_COMMENT:
+                last = pos, quoted
+            pos = quoted
+        elif kind == _K_REGISTER:
+            last = _bound_span(bindings, buf[pos])
+            pos += 1
+        else:
+            # lists
+            last = None
+            pos += 1
+    if last is None:
+        raise _FullDecode()
+    return last
+
+def _bind(buf: memoryview, pos: int, span: tuple, bindings: list):
+    if pos + 1 >= len(buf) or _byte_kinds[buf[pos + 1]] != _K_REGISTER:
+        raise _FullDecode()
+    bindings.append((pos, buf[pos + 1], span))
+
+def _skip_nested(buf: memoryview, pos: int, in_tag: bool, bindings: list) -> int:
+    # returns the end of the tuple starting at pos,
+    # or of the tag if in_tag, the tag ends with ` or $ outside of tuples
+    depth = 0 if in_tag else 1
+    opened = []     # starts of the tuples open inside
+    last = None     # span of the last tuple or binary
+    pos += 1
+    floor = pos
+    while True:
+        segment = pos
+        match = _skip_re.match(buf, pos)
+        if match is None:
+            raise _FullDecode()
+        pos = match.start(1)
+        byte = buf[pos]
+        if byte == tuple_open_b[0]:
+            depth += 1
+            opened.append(pos)
+        elif byte == tuple_end_b[0]:
+            depth -= 1
+            if depth == 0 and not in_tag:
+                return pos + 1
+            if not opened:
+                raise _FullDecode()
+            last = opened.pop(), pos + 1
+        elif byte == tilde_b[0]:
+            last = _binary_span(buf, pos, floor)
+            if last is None or last[1] > len(buf):
+                raise _FullDecode()
+            pos = floor = last[1]
+            continue
+        elif byte == bind_b[0]:
+            if last is not None and last[1] == pos:
+                span = last
+            else:
+                span = _last_atom(buf, segment, pos, bindings)
+            _bind(buf, pos, span, bindings)
+            pos += 2
+            continue
+        elif byte in semanticquote + end_b and depth == 0 and in_tag:
+            return pos + 1
+        elif byte == end_b[0] or byte not in semanticquote:
+            # $ in a tuple, quote not closed
+            raise _FullDecode()
+        pos += 1
+
+def _element_spans(buf: memoryview, pos: int, in_tuple: bool, bindings: list):
+    # returns [start, end, is integer] of the elements from pos
+    # till the } or $ (or the end of buffer)
+    spans = []
+    n = len(buf)
+    while True:
+        token = _token_re.match(buf, pos)
+        if token is None:
+            if in_tuple:
+                raise _FullDecode()
+            return spans
+        group = token.lastindex
+        if group != _TOKEN_OTHER:
+            spans.append([token.start(group) - (group != _TOKEN_INT), token.end(), group == _TOKEN_INT])
+            pos = token.end()
+            continue
+
+        pos = token.start(group)
+        kind = _byte_kinds[buf[pos]]
+        if kind in (_K_STR, _K_CONST, _K_COMMENT):
+            end = _quoted_body_re[buf[pos]].match(buf, pos + 1).end()
+            if end == n or buf[end] != buf[pos]:
+                raise _FullDecode()
+            if kind != _K_COMMENT:
+                spans.append([pos, end + 1, False])
+            pos = end + 1
+        elif kind == _K_BIN:
+            if not spans or not spans[-1][2] or buf[spans[-1][0]] == minus_b[0]:
+                raise _FullDecode()
+            end = pos + 1 + int(bytes(buf[spans[-1][0]:spans[-1][1]]))
+            if end > n:
+                raise _FullDecode()
+            if end < n and buf[end] == tilde_b[0]:
+                end += 1
+            spans[-1][1:] = end, False
+            pos = end
+        elif kind == _K_OPEN:
+            end = _skip_nested(buf, pos, False, bindings)
+            spans.append([pos, end, False])
+            pos = end
+        elif kind == _K_LIST:
+            spans.append([pos, pos + 1, False])
+            pos += 1
+        elif kind == _K_APPEND:
+            if len(spans) < 2 or buf[spans[-2][0]] != list_b[0]:
+                raise _FullDecode()
+            spans.pop()
+            spans[-1][1] = pos + 1
+            pos += 1
+        elif kind == _K_TAG:
+            if not spans:
+                raise _FullDecode()
+            end = _skip_nested(buf, pos, True, bindings)
+            spans[-1][1:] = end, False
+            pos = end
+        elif kind == _K_REGISTER:
+            # unbound registers are left to the full decode
+            _bound_span(bindings, buf[pos])
+            spans.append([pos, pos + 1, False])
+            pos += 1
+        elif kind == _K_BIND:
+            if not spans:
+                raise _FullDecode()
+            span = spans.pop()
+            _bind(buf, pos, (span[0], span[1]), bindings)
+            pos += 2
+        elif kind == (_K_CLOSE if in_tuple else _K_END):
+            return spans
+        else:
+            # a lone minus, unbalanced } or $
+            raise _FullDecode()
+
+def _decode_bound_span(buf: memoryview, start: int, end: int, bindings: list, decoded: dict):
+    # decoded: the elements of the bindings, by the position of >
+    stack = MappedRecognitionStack(buf[start:end])
+    live = {}
+    for binding in bindings:
+        if binding[0] >= start:
+            break
+        live[binding[1]] = binding
+    for register, (pos, _, span) in live.items():
+        if pos not in decoded:
+            decoded[pos] = _decode_bound_span(buf, span[0], span[1], bindings, decoded)
+        stack.registers[register] = decoded[pos]
+    return stack.recognize()[0]
+
+def decode_path(source, path: tuple = ()):
+    """decode_path(source, path = ())
+
+    Returns the subterm of the message at the start of the source
+    (bytes, mmap or another buffer) at the path of indices,
+    as message[path[0]][path[1]]...
+
+    Only the tuples on the path are scanned element by element,
+    the rest is skipped, until a list, which is decoded and indexed.
+    The elements are recognized as with MappedRecognitionStack,
+    the binaries are memoryview slices of the source.
+
+    The tuples on the path and the subterm are checked as by a full decode,
+    and raise FormatError; the skipped elements are not,
+    so a message invalid only inside them may still give its subterm.
+    A path missing from the message raises IndexError or TypeError
+    as indexing the decoded message does.
+    """
+
+    buf = memoryview(source).cast("B")
+    try:
+        bindings = []
+        spans = _element_spans(buf, 0, False, bindings)
+        if len(spans) != 1:
+            raise _FullDecode()
+        start, end = spans[0][:2]
+        for i, step in enumerate(path):
+            # the bindings after the start are found again inside
+            bindings = [b for b in bindings if b[0] < start]
+            if buf[start] != tuple_open_b[0]:
+                element = _decode_bound_span(buf, start, end, bindings, {})
+                for step in path[i:]:
+                    element = element[step]
+                return element
+            start, end = _element_spans(buf, start + 1, True, bindings)[step][:2]
+        return _decode_bound_span(buf, start, end, bindings, {})
+    except (_FullDecode, IndexError, TypeError):
+        # a path missing from the message raises as the indexing does,
+        # unless the message is invalid past the skipped part
+        element = MappedRecognitionStack(buf).recognize()[0]
+        for step in path:
+            element = element[step]
+        return element
+
+
+# Encoding
+
+def _quote(quote: bytes, content: str, out: bytearray):
+    content = content.encode(text_encoding)
+    if backslash_b in content or quote in content:
+        content = content.replace(backslash_b, backslash_b * 2).replace(quote, backslash_b + quote)
+    out += quote
+    out += content
+    out += quote
+
+def _register_key(element):
+    """_register_key(element)
+
+    Key of an element in the register table,
+    or None if it is not worth a register: composites, tagged elements, digits.
+    Str and Const of the same text get different keys.
+    """
+
+    if getattr(element, "semantic_tag", None) is not None:
+        return None
+    if isinstance(element, int):
+        return None if 0 <= element <= 9 else (int, int(element))
+    if isinstance(element, UBF_Const):
+        return (UBF_Const, str(element))
+    if isinstance(element, str):
+        return (str, str(element))
+    if isinstance(element, (bytes, memoryview)):
+        try:
+            return (bytes, element, hash(element))
+        except TypeError:
+            # a view of a mutable buffer
+            return None
+    return None
+
+def _is_int_ndarray(element):
+    # without importing numpy
+    return type(element).__name__ == "ndarray" and getattr(element, "ndim", None) == 1 and element.dtype.kind in "iu"
+
+def _is_tagged(element):
+    # element or one of its elements has a semantic tag
+    todo = [element]
+    while todo:
+        element = todo.pop()
+        if getattr(element, "semantic_tag", None) is not None:
+            return True
+        if isinstance(element, (tuple, list)):
+            todo.extend(element)
+    return False
+
+def _register_bytes():
+    # in the order of ubf.Encoder.regpref
+    preferred = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ.:;[]\\|+=_()*^@!"
+    return preferred + bytes(b for b in range(255, -1, -1) if b not in preferred and b not in reserved_b)
+
+class Encoder:
+    """
+    Encodes UBF elements, or plain int, str, bytes, tuple and list,
+    into bytearrays.
+
+    Elements repeated in a message are bound to registers,
+    as ubf.Encoder does with buildTable.
+    Lists are written to be appended in order, as RecognitionStack reads them.
+
+    In a session the registers stay bound from one message to the next,
+    the least recently used register is bound to the next new element.
+    The decoder follows by keeping its registers, see ubf.Encoder.
+
+    stats is called with the MessageStats of each message.
+    """
+
+    registers = _register_bytes()
+
+    def __init__(self, session: bool = False, seen_limit: int = None, stats = None):
+        self.table = None
+        self.session = session
+        self.stats = stats
+        self._hits = self._binds = 0
+        if session:
+            self.session_table = collections.OrderedDict() # key: register, least recently used first
+            self.free_registers = list(reversed(self.registers))
+            # keys of the earlier messages, bound when seen again
+            self.seen = collections.OrderedDict()
+            self.seen_limit = seen_limit or 4 * len(self.registers)
+
+    def build_table(self, element):
+        """build_table(self, element)
+
+        Counts the atoms of the element.
+        Returns the table {key: [register byte, bound]}
+        of the atoms found more than once, the most frequent first.
+        """
+
+        counts = {}
+        # in the order of the message, the ties are kept in it
+        todo = [element]
+        while todo:
+            x = todo.pop()
+            if isinstance(x, (tuple, list)):
+                todo.extend(reversed(x))
+            else:
+                key = _register_key(x)
+                if key is not None:
+                    counts[key] = counts.get(key, 0) + 1
+
+        if self.session:
+            return self._build_session_table(counts)
+        repeated = sorted((k for k, c in counts.items() if c > 1), key=counts.get, reverse=True)
+        return {key: [register, False] for key, register in zip(repeated, self.registers)}
+
+    def _build_session_table(self, counts):
+        table = {}
+        fresh = []
+        for key, count in counts.items():
+            if key in self.session_table:
+                # bound in an earlier message
+                self.session_table.move_to_end(key)
+                table[key] = [self.session_table[key], True]
+            elif count > 1 or key in self.seen:
+                fresh.append(key)
+
+        fresh.sort(key=counts.get, reverse=True)
+        for key in fresh:
+            if self.free_registers:
+                register = self.free_registers.pop()
+            else:
+                old, register = self.session_table.popitem(last=False)
+                if old in table:
+                    # all registers are used in this message
+                    self.session_table[old] = register
+                    break
+            self.session_table[key] = register
+            table[key] = [register, False]
+
+        for key in counts:
+            self.seen[key] = True
+            self.seen.move_to_end(key)
+        while len(self.seen) > self.seen_limit:
+            self.seen.popitem(last=False)
+        return table
+
+    def encode(self, element, build_table: bool = True) -> bytes:
+        """encode(self, element, build_table = True)
+
+        Returns the UBF message of the element, ending with $.
+        """
+
+        out = bytearray()
+        self.encode_into(element, out, build_table)
+        return bytes(out)
+
+    def encode_into(self, element, out: bytearray, build_table: bool = True):
+        """encode_into(self, element, out, build_table = True)
+
+        Appends the UBF message of the element to the bytearray.
+        """
+
+        if self.stats is not None:
+            started = time.perf_counter()
+            size = len(out)
+
+        self._hits = self._binds = 0
+        self.table = self.build_table(element) if build_table else None
+        self._encode(element, out)
+        out += end_b
+
+        if self.stats is not None:
+            counts, depth = _element_counts(element)
+            self.stats(MessageStats("encode", len(out) - size, counts, depth, self._hits, self._binds,
+                                    time.perf_counter() - started))
+
+    def _encode(self, element, out: bytearray):
+        # with a stack of the elements still to encode and the ends of the begun ones,
+        # not to recurse into each level of nesting, as the decoders read them
+        table = self.table
+        ending = _Ending
+        append = _APPEND
+        tuple_end = _TUPLE_END
+        todo = [element]
+        pop, push = todo.pop, todo.append
+        while todo:
+            element = pop()
+            if type(element) is ending:
+                out += element.closing
+                if element.element is None:
+                    # nothing more but the bind, if any
+                    if element.entry:
+                        self._bind(element.entry, out)
+                    continue
+                entry = element.entry
+                element = element.element
+            else:
+                entry = None
+                if table:
+                    entry = table.get(_register_key(element))
+                    if entry and entry[1]:
+                        out.append(entry[0])
+                        self._hits += 1
+                        continue
+
+                if isinstance(element, int):
+                    if out and out[-1] in int_b:
+                        out += b" " # separate from the previous integer
+                    out += b"%d" % element
+                elif isinstance(element, UBF_Const):
+                    _quote(constquote, element, out)
+                elif isinstance(element, str):
+                    _quote(stringquote, element, out)
+                elif isinstance(element, (bytes, bytearray, memoryview)):
+                    if out and out[-1] in int_b:
+                        out += b" "
+                    out += b"%d~" % (element.nbytes if isinstance(element, memoryview) else len(element))
+                    out += element
+                    out += tilde_b
+                elif isinstance(element, UBF_BinFile):
+                    if out and out[-1] in int_b:
+                        out += b" "
+                    out += b"%d~" % element.length
+                    element.seek(0)
+                    for data in iter(lambda: element.read(1 << 16), b""):
+                        out += data
+                    element.seek(0)
+                    out += tilde_b
+                elif isinstance(element, UBF_IntList):
+                    out += list_b
+                    if element:
+                        out += "&".join(map(str, element)).encode()
+                        out += append_b
+                elif (isinstance(element, array.array) and element.typecode in "bBhHiIlLqQ") or _is_int_ndarray(element):
+                    # UBF_IntTuple, or the arrays of integers
+                    out += tuple_open_b
+                    out += " ".join(map(str, element.tolist())).encode()
+                    out += tuple_end_b
+                elif isinstance(element, tuple):
+                    out += tuple_open_b
+                    if entry or getattr(element, "semantic_tag", None) is not None:
+                        push(ending(tuple_end_b, element, entry))
+                    else:
+                        push(tuple_end)
+                    todo.extend(reversed(element))
+                    continue
+                elif isinstance(element, list):
+                    out += list_b
+                    if entry or getattr(element, "semantic_tag", None) is not None:
+                        push(ending(b"", element, entry))
+                    for x in reversed(element):
+                        push(append)
+                        push(x)
+                    continue
+                else:
+                    raise FormatError("Cannot encode %s to UBF" % type(element))
+
+            # after the contents of the element: its semantic tag, then its bind
+            tag = getattr(element, "semantic_tag", None)
+            if tag is not None:
+                if _is_tagged(tag):
+                    # its ` would end the tag
+                    raise FormatError("Cannot encode a tag holding a tagged element to UBF")
+                out += semanticquote
+                push(ending(semanticquote, None, entry))
+                push(tag)
+            elif entry:
+                self._bind(entry, out)
+
+    def _bind(self, entry, out: bytearray):
+        # bind and push it back
+        entry[1] = True
+        self._binds += 1
+        self._hits += 1 # pushed back, as the decoder counts it
+        out += bind_b
+        out.append(entry[0])
+        out.append(entry[0])
+
+class _Ending:
+    """
+    The end of an element begun by Encoder._encode, after its contents:
+    the closing bytes, then the semantic tag of the element and its bind.
+    """
+
+    __slots__ = ("closing", "element", "entry")
+
+    def __init__(self, closing: bytes, element, entry):
+        self.closing = closing
+        self.element = element  # None if only the bind is left
+        self.entry = entry
+
+# after each element of a list, and after an untagged and unbound tuple
+_APPEND = _Ending(append_b, None, None)
+_TUPLE_END = _Ending(tuple_end_b, None, None)
+
+def encode(element, build_table: bool = True) -> bytes:
+    """encode(element, build_table = True)
+
+    Encodes the UBF element, or a plain int, str, bytes, tuple or list,
+    into a UBF message ending with $.
+    """
+
+    return Encoder().encode(element, build_table)
+
+
+test_UBF_bytestreams = [ b'"foo" `{124 "bar" `4~ab01~`}`',
+                         b'{"foo">a a a 12>b \'b\\\'\' b}' ]
 
 if __name__ == '__main__':
     print("running tests:")
     for s in test_UBF_bytestreams:
         print(RecognitionStack(s).recognize())
+        print(BufferedRecognitionStack(s).recognize())
+        parser = IncrementalRecognitionStack()
+        for i in range(len(s)):
+            parser.feed(s[i:i + 1])
+        print(parser.close())
+
+
+    print("checking:")
+    messages = [UBF_Tuple((UBF_Int(i), UBF_Str("message %d" % i), UBF_Const("c"), UBF_List([UBF_Int(i)] * 3)))
+                for i in range(200)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "messages.ubf")
+        with open(path, "wb") as f:
+            f.write(b"".join(encode(m) for m in messages[:100]))
+        index = MessageIndex(path)
+        assert len(index) == 100 and list(index.messages()) == messages[:100]
+        with open(path, "ab") as f:
+            f.write(b"".join(encode(m) for m in messages[100:]))
+        assert index.update() == 100 and index[150] == messages[150]
+        index.close()
+        index = MessageIndex(path)
+        assert index.update() == 0 and list(index.messages(190)) == messages[190:]
+        assert list(decode_parallel(path, 2, 1000)) == messages
+        assert list(decode_parallel(path, 2, 1000, index, len)) == [len(m) for m in messages]
+        index.close()
+        # rewritten with the same length, indexed again
+        with open(path, "r+b") as f:
+            f.write(encode(UBF_Tuple((UBF_Int(9), UBF_Str("message 0"), UBF_Const("c"), UBF_List([UBF_Int(9)] * 3)))))
+        index = MessageIndex(path)
+        assert len(index) == 200 and index[0][0] == 9 and index[1] == messages[1]
+        index.close()
 
+    path_message = b'{1 {"foo">a a {a \'b\'}} #4&5& 2~ab~}$'
+    full = MappedRecognitionStack(path_message).recognize()[0]
+    for path in ((), (0,), (1,), (1, 1), (1, 1, 0), (2,), (2, 1), (3,)):
+        subterm = full
+        for i in path:
+            subterm = subterm[i]
+        print(path, decode_path(path_message, path))
+        assert decode_path(path_message, path) == subterm
+    for path in ((4,), (0, 0)):
+        try:
+            decode_path(path_message, path)
+        except (IndexError, TypeError):
+            pass
+        else:
+            raise AssertionError(path)
+
+    int_messages = MappedRecognitionStack(b'{1 2 3}$#1&2&$ {1 "a"}$', int_arrays=True)
+    for element, kind in zip(int_messages, (UBF_IntTuple, UBF_IntList, UBF_Tuple)):
+        print(element)
+        assert isinstance(element, kind) and list(element) in ([1, 2, 3], [1, 2], [1, "a"])
+
+    # a negative binary length must not read the rest of the stream
+    tight = Limits(max_binary=10, max_message_bytes=100)
+    negative = b"-1~" + b"x" * 10000 + b"~$"
+    for recognize in (lambda: RecognitionStack(io.BytesIO(negative), limits=tight).recognize(),
+                      lambda: BufferedRecognitionStack(io.BytesIO(negative), limits=tight).recognize(),
+                      lambda: MappedRecognitionStack(negative, limits=tight).recognize(),
+                      lambda: IncrementalRecognitionStack(limits=tight).feed(negative),
+                      lambda: list(iter_events(io.BytesIO(negative), limits=tight))):
+        try:
+            recognize()
+        except FormatError:
+            pass
+        else:
+            raise AssertionError("negative binary length accepted")
+    # nesting is not bound by the recursion limit of Python
+    deep_tuple, deep_list = UBF_Tuple(), UBF_List()
+    for _ in range(200000):
+        deep_tuple, deep_list = UBF_Tuple((deep_tuple,)), UBF_List((deep_list,))
+    assert encode(deep_tuple) == b"{" * 200001 + b"}" * 200001 + b"$"
+    assert encode(deep_list) == b"#" * 200001 + b"&" * 200000 + b"$"
+    assert encode(UBF_Tuple((tagged(deep_tuple[0], "deep"),))).endswith(b"}`\"deep\"`}$")
+    print("ok")
@@ -20,9 +20,14 @@
 #
 from __future__ import nested_scopes
 
+import heapq
+import re
 import sys
 import string
+import time
 import types
+import weakref
+from collections import OrderedDict
 
 __author__ = 'Tony Garnock-Jones'
 __email__ = 'tonyg@kcbbs.gen.nz'
@@ -51,9 +56,39 @@ class Tag:
     def __str__(self):
         return repr(self)
 
-class Symbol:
-    def __init__(self, name):
-        self.name = name
+def _uninterning(table, key):
+    # the callback of the weak reference in the table,
+    # unless the key was interned again
+    def drop(ref):
+        if table.get(key) is ref:
+            del table[key]
+    return drop
+
+class Symbol(object):
+    """Equal symbols are one object, interned in Symbol.interned,
+    so they compare by identity.
+    The table holds weak references, a symbol no longer used is dropped.
+    """
+    __slots__ = ('name', '__weakref__')
+    interned = {} # name: weak reference to the symbol
+
+    def __new__(cls, name):
+        if cls is not Symbol:
+            symbol = object.__new__(cls)
+            symbol.name = name
+            return symbol
+        ref = Symbol.interned.get(name)
+        if ref is not None:
+            symbol = ref()
+            if symbol is not None:
+                return symbol
+        symbol = object.__new__(cls)
+        symbol.name = name
+        Symbol.interned[name] = weakref.ref(symbol, _uninterning(Symbol.interned, name))
+        return symbol
+
+    def __reduce__(self):
+        return (self.__class__, (self.name,))
 
     def __cmp__(self, other):
         if isinstance(other, Symbol):
@@ -95,12 +130,169 @@ def digit_to_number(x): return ord(x) - ord('0')
 
 class FormatError(Exception): pass
 class EndOfStream(FormatError): pass
+class LimitExceeded(FormatError): pass
+
+class MessageStats:
+    """Statistics of one message, given to the stats callback of
+    Decoder, TokenDecoder and Encoder:
+
+    operation     -- 'decode' or 'encode'
+    bytes         -- length of the message
+    counts        -- number of elements by type, 'int', 'str', 'symbol',
+                     'binary', 'tuple', 'list' and 'tag'; an element read
+                     from a register is counted again
+    depth         -- the deepest nesting of tuples, lists and tags
+    register_hits -- elements read from (or written as) a register
+    binds         -- elements bound to a register
+    seconds       -- wall time spent on the message
+    """
+    def __init__(self, operation, bytes, counts, depth, register_hits, binds, seconds):
+        self.operation = operation
+        self.bytes = bytes
+        self.counts = counts
+        self.depth = depth
+        self.register_hits = register_hits
+        self.binds = binds
+        self.seconds = seconds
+
+    def __repr__(self):
+        return '<ubf.MessageStats ' + repr(self.__dict__) + '>'
+
+class StatsCounter:
+    """Sums the MessageStats it is called with; pass it as stats to
+    aggregate over a connection.
+    """
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.counts = {}
+        self.max_depth = 0
+        self.register_hits = 0
+        self.binds = 0
+        self.seconds = 0.0
+
+    def __call__(self, stats):
+        self.messages = self.messages + 1
+        self.bytes = self.bytes + stats.bytes
+        for (k, v) in stats.counts.iteritems():
+            self.counts[k] = self.counts.get(k, 0) + v
+        self.max_depth = max(self.max_depth, stats.depth)
+        self.register_hits = self.register_hits + stats.register_hits
+        self.binds = self.binds + stats.binds
+        self.seconds = self.seconds + stats.seconds
+
+    def __repr__(self):
+        return '<ubf.StatsCounter ' + repr(self.__dict__) + '>'
+
+# the element counted by MessageStats for each exact type,
+# the instances of Tag and Binary and subclasses of Symbol are looked up
+_element_kinds = {types.TupleType: 'tuple', types.ListType: 'list',
+                  types.IntType: 'int', types.LongType: 'int',
+                  types.StringType: 'str', Symbol: 'symbol'}
+
+def _element_counts(object):
+    # counts and depth of MessageStats, a level of nesting at a time
+    counts = {'int': 0, 'str': 0, 'symbol': 0, 'binary': 0,
+              'tuple': 0, 'list': 0, 'tag': 0}
+    kinds = _element_kinds
+    depth = -1
+    level = [object]
+    while level:
+        depth = depth + 1
+        inner = []
+        for x in level:
+            kind = kinds.get(type(x))
+            if kind is None:
+                if isinstance(x, Tag):
+                    kind = 'tag'
+                    inner.append(x.value)
+                elif isinstance(x, Symbol):
+                    kind = 'symbol'
+                elif isinstance(x, Binary):
+                    kind = 'binary'
+                else:
+                    continue
+            elif kind == 'tuple' or kind == 'list':
+                inner.extend(x)
+            counts[kind] = counts[kind] + 1
+        level = inner
+    return counts, depth
+
+class Limits:
+    """Bounds of the messages Decoder and TokenDecoder accept, None for
+    no bound:
+
+    max_depth         -- structs open one inside the other
+    max_message_bytes -- length of a message
+    max_binary        -- length of a binary
+    max_string        -- length of a string, symbol, tag name or comment
+                         between its quotes, escapes included
+    max_registers     -- elements bound to a register in a message
+
+    A message going over one of them raises LimitExceeded, before the
+    element over the limit is read.
+    """
+    def __init__(self, max_depth = None, max_message_bytes = None, max_binary = None,
+                 max_string = None, max_registers = None):
+        self.max_depth = max_depth
+        self.max_message_bytes = max_message_bytes
+        self.max_binary = max_binary
+        self.max_string = max_string
+        self.max_registers = max_registers
+
+    def __repr__(self):
+        return '<ubf.Limits ' + repr(self.__dict__) + '>'
+
+def _limit_bounds(limits):
+    # the limits without None, for plain comparisons while decoding
+    if limits is None:
+        limits = Limits()
+    bounds = []
+    for x in (limits.max_depth, limits.max_message_bytes, limits.max_binary,
+              limits.max_string, limits.max_registers):
+        if x is None:
+            x = sys.maxint
+        bounds.append(x)
+    return tuple(bounds)
+
+class _ConsList(object):
+    """A list being built with & on the Decoder stack.
+
+    Consing prepends, so the elements are kept in reverse and the
+    list is put in order once, when it is popped off the stack.
+    """
+    def __init__(self, reversed_items):
+        self.reversed_items = reversed_items
+
+    def __repr__(self):
+        return '_ConsList(' + repr(self.reversed_items[::-1]) + ')'
 
 class Decoder:
-    def __init__(self, coll):
+    def __init__(self, coll, session = False, stats = None, limits = None):
+        # in a session the registers stay bound from one message to the next,
+        # see Encoder
+        self.session = session
+        # called with the MessageStats of each message
+        self.stats = stats
+        # the Limits of the messages
+        self.limits = limits
+        (self._max_depth, self._max_bytes, self._max_binary,
+         self._max_string, self._max_binds) = _limit_bounds(limits)
+        # the position past which the current message is over the limit
+        self._message_end = sys.maxint
+        self._hits = 0
+        self._binds = 0
+        self._read = 0
         self._iter = iter(coll)
+        if stats is not None or limits is not None:
+            self._chargen = self._counted_chargen
         self.dispatch = None
+        # the terms bound to each register, also read by their handlers
+        # in the dispatch table
+        self.registers = {}
         self.stack = []
+        # stack indices of the first elements of the open structs
+        self.frames = []
         self.result = None
         self.defaultDispatch = {'%': self._handleComment,
                                 '"': self._handleString,
@@ -131,9 +323,16 @@ class Decoder:
                                 ',': self._ignore }
 
     def decode(self):
-        self.dispatch = self.defaultDispatch.copy()
+        if self.dispatch is None or (self._binds and not self.session):
+            self._drop_registers()
         self.stack = []
+        self.frames = []
         self.result = None
+        self._hits = 0
+        self._binds = 0
+        self._message_end = self._position() + self._max_bytes
+        if self.stats is not None:
+            started = (self._position(), time.time())
 
         ch = None
         while self.result is None:
@@ -145,8 +344,24 @@ class Decoder:
             else:
                 raise FormatError('Unhandled UBF-A character', ch)
 
+        if self.stats is not None:
+            self._report(started)
         return self.result
 
+    def _drop_registers(self):
+        # the registers bound by the last message are dropped
+        self.dispatch = self.defaultDispatch.copy()
+        self.registers.clear()
+
+    def _position(self):
+        # characters read so far, counted only with stats or limits
+        return self._read
+
+    def _report(self, started):
+        (counts, depth) = _element_counts(self.result)
+        self.stats(MessageStats('decode', self._position() - started[0], counts, depth,
+                                self._hits, self._binds, time.time() - started[1]))
+
     def __iter__(self):
         return self
 
@@ -160,12 +375,21 @@ class Decoder:
         self.stack.append(x)
 
     def _pop(self):
-        return self.stack.pop()
+        return self._finished(self.stack.pop())
+
+    def _finished(self, x):
+        if isinstance(x, _ConsList):
+            x.reversed_items.reverse()
+            return x.reversed_items
+        return x
 
     def _peek(self):
         return self.stack[-1]
 
     def _empty(self):
+        # empty up to the innermost open struct
+        if self.frames:
+            return len(self.stack) == self.frames[-1]
         return (len(self.stack) == 0)
 
     def _chargen(self):
@@ -174,21 +398,48 @@ class Decoder:
         except StopIteration:
             raise EndOfStream()
 
+    def _counted_chargen(self):
+        # _chargen with stats or limits
+        try:
+            ch = self._iter.next()
+        except StopIteration:
+            raise EndOfStream()
+        self._read = self._read + 1
+        if self._read > self._message_end:
+            raise LimitExceeded('Message over the limit', self._max_bytes)
+        return ch
+
     def _collect_quoted(self, stopchar):
+        # read from the source as a run, counted in _read at its end
+        next = self._iter.next
         acc = []
+        # characters between the quotes, escapes included
+        size = 0
+        # past this size the text or its message is over the limit
+        limit = min(self._max_string, self._message_end - self._read - 1)
 
-        while 1:
-            char = self._chargen()
-            if char == '\\':
-                ch2 = self._chargen()
-                if ch2 in ('\\', stopchar):
-                    acc.append(ch2)
+        try:
+            while 1:
+                char = next()
+                if char == '\\':
+                    ch2 = next()
+                    if ch2 in ('\\', stopchar):
+                        acc.append(ch2)
+                    else:
+                        raise FormatError('Unsupported quoted character', ch2, stopchar)
+                    size = size + 2
+                elif char == stopchar:
+                    self._read = self._read + size + 1
+                    return string.join(acc, '')
                 else:
-                    raise FormatError('Unsupported quoted character', ch2, stopchar)
-            elif char == stopchar:
-                return string.join(acc, '')
-            else:
-                acc.append(char)
+                    acc.append(char)
+                    size = size + 1
+                if size > limit:
+                    if size > self._max_string:
+                        raise LimitExceeded('Quoted text over the limit', self._max_string)
+                    raise LimitExceeded('Message over the limit', self._max_bytes)
+        except StopIteration:
+            raise EndOfStream()
 
     def _handleComment(self, char):
         self._collect_quoted(char)
@@ -212,27 +463,50 @@ class Decoder:
         if self._empty() or type(self._peek()) not in NumTypes:
             raise FormatError('Binary data must be preceded by length')
         binlen = self._pop()
+        self._check_binary(binlen)
+        # read from the source as a run, as _collect_quoted
+        next = self._iter.next
         acc = []
         i = 0
-        while i < binlen:
-            acc.append(self._chargen())
-            i = i + 1
+        try:
+            while i < binlen:
+                acc.append(next())
+                i = i + 1
+        except StopIteration:
+            raise EndOfStream()
+        self._read = self._read + binlen
         if self._chargen() != '~':
             raise FormatError('Binary data must be followed by tilde')
         self._push(Binary(string.join(acc, '')))
         return None
 
+    def _check_binary(self, binlen):
+        if binlen > self._max_binary:
+            raise LimitExceeded('Binary over the limit', binlen, self._max_binary)
+        if self._position() + binlen > self._message_end:
+            raise LimitExceeded('Message over the limit', self._max_bytes)
+
     def _handleNull(self, ch):
-        self._push([])
+        self._push(_ConsList([]))
         return None
 
     def _handleCons(self, ch):
+        if self._empty(): raise FormatError('Cons must follow item')
         a = self._pop()
-        self._peek().insert(0, a)
+        if self._empty(): raise FormatError('Cons onto a non-list', a)
+        tail = self._peek()
+        if not isinstance(tail, _ConsList):
+            if type(tail) != types.ListType:
+                raise FormatError('Cons onto a non-list', tail)
+            # a finished list, e.g. from a register: cons onto a copy
+            tail = _ConsList(tail[::-1])
+            self.stack[-1] = tail
+        tail.reversed_items.append(a)
         return None
 
     def _handleEom(self, ch):
         if self._empty(): raise FormatError('Empty stack at end of message')
+        if self.frames: raise FormatError('Struct not closed at UBF EOM token')
         self.result = self._pop()
         if not self._empty(): raise FormatError('Rubbish remains on stack at UBF EOM token')
         return None
@@ -241,9 +515,15 @@ class Decoder:
         ch = self._chargen()
         if ch in ubf_a_reserved_chars:
             raise FormatError('Attempt to bind to reserved character', ch)
+        if self._empty(): raise FormatError('Bind must follow item', ch)
+        if self._binds >= self._max_binds:
+            raise LimitExceeded('Binds over the limit', self._max_binds)
         val = self._pop()
+        self._binds = self._binds + 1
+        self.registers[ch] = val
         def handler(dummy2):
             self._push(val)
+            self._hits = self._hits + 1
             return None
         self.dispatch[ch] = handler
         return None
@@ -265,19 +545,20 @@ class Decoder:
                 return ch
 
     def _handleOpenStruct(self, ch):
-        self._push({}) # magic marker
+        if len(self.frames) >= self._max_depth:
+            raise LimitExceeded('Depth of structs over the limit', self._max_depth)
+        # the struct elements go on the same stack, after the frame index
+        self.frames.append(len(self.stack))
         return None
 
     def _handleCloseStruct(self, ch):
-        acc = []
-        while 1:
-            v = self._pop()
-            if v == {}:
-                acc.reverse()
-                self._push(tuple(acc))
-                break
-            else:
-                acc.append(v)
+        if not self.frames: raise FormatError('Struct end without struct start')
+        start = self.frames.pop()
+        items = self.stack[start:]
+        del self.stack[start:]
+        if _ConsList in map(type, items):
+            items = map(self._finished, items)
+        self._push(tuple(items))
         return None
 
     def _ignore(self, ch):
@@ -289,10 +570,399 @@ class Decoder:
     def __str__(self):
         return repr(self)
 
+# Tokens of the common cases, after a run of whitespace:
+# integers, strings, symbols and semantic tags without escapes, comments,
+# runs of registers and of struct starts;
+# any other character goes through the dispatch table.
+_token_re = re.compile(r"""[ \n\r\t,]*(?:(-?[0-9]+)|"([^"\\]*)"|'([^'\\]*)'|`([^`\\]*)`|%[^%\\]*%|([^""" +
+                       re.escape(ubf_a_reserved_chars) + r"""]+)|(\{+)|([^ \n\r\t,]))""")
+# runs of quoted characters up to the quote or a backslash
+_quoted_run_re = dict([(q, re.compile(r'[^%s\\]*' % re.escape(q))) for q in '"\'`%'])
+
+class TokenDecoder(Decoder):
+    """Decoder matching whole tokens instead of dispatching each character.
+
+    Reads a string, a file-like object (in chunks of chunk_size) or an
+    iterable of strings. Produces the same terms and FormatErrors as Decoder.
+    """
+
+    def __init__(self, source, session = False, chunk_size = 65536, stats = None, limits = None):
+        Decoder.__init__(self, (), session, None, limits)
+        self.stats = stats
+        self.chunk_size = chunk_size
+        if type(source) == types.StringType:
+            self._buf = source
+            self._chunks = iter(())
+        elif hasattr(source, 'read'):
+            self._buf = ''
+            self._chunks = iter(lambda: source.read(chunk_size), '')
+        else:
+            self._buf = ''
+            self._chunks = iter(source)
+        self._pos = 0
+        # characters dropped off the front of the buffer
+        self._dropped = 0
+
+    def _fill(self):
+        # the buffer holds the current message up to its end
+        if self._dropped + len(self._buf) > self._message_end:
+            raise LimitExceeded('Message over the limit', self._max_bytes)
+        for chunk in self._chunks:
+            if chunk:
+                self._dropped = self._dropped + self._pos
+                self._buf = self._buf[self._pos:] + chunk
+                self._pos = 0
+                return True
+        return False
+
+    def decode(self):
+        if self.dispatch is None or (self._binds and not self.session):
+            self._drop_registers()
+        self.stack = []
+        self.frames = []
+        self.result = None
+        self._hits = 0
+        self._binds = 0
+        self._message_end = self._position() + self._max_bytes
+        if self.stats is not None:
+            started = (self._position(), time.time())
+
+        match = _token_re.match
+        stack = self.stack
+        frames = self.frames
+        push = stack.append
+        registers = self.registers
+        finished = self._finished
+        maxDepth = self._max_depth
+        maxString = self._max_string
+        # set once a _ConsList may be on the stack, only # and & push them
+        conses = False
+        buf = self._buf
+        pos = self._pos
+        # the message is over the limit past this position of buf
+        last = self._message_end - self._dropped
+        while self.result is None:
+            m = match(buf, pos)
+            if m is None or (m.lastindex == 1 and m.end() == len(buf)):
+                # only whitespace left, or an integer may go on in the next chunk
+                self._pos = pos
+                if not self._fill():
+                    raise EndOfStream()
+                buf = self._buf
+                pos = self._pos
+                last = self._message_end - self._dropped
+                continue
+
+            pos = m.end()
+            if pos > last:
+                raise LimitExceeded('Message over the limit', self._max_bytes)
+            token = m.lastindex
+            if token == 1:
+                push(int(m.group(1)))
+            elif token == 5:
+                run = m.group(5)
+                try:
+                    if len(run) == 1:
+                        push(registers[run])
+                    else:
+                        stack.extend(map(registers.__getitem__, run))
+                except KeyError as e:
+                    raise FormatError('Unhandled UBF-A character', e.args[0])
+                self._hits = self._hits + len(run)
+            elif token == 7 and m.group(7) == '}' and frames:
+                # as _handleCloseStruct
+                start = frames.pop()
+                items = stack[start:]
+                del stack[start:]
+                if conses and _ConsList in map(type, items):
+                    items = map(finished, items)
+                push(tuple(items))
+            elif token == 2 or token == 3 or token == 4:
+                # measured before the text is copied out of the buffer
+                if m.end(token) - m.start(token) > maxString:
+                    raise LimitExceeded('Quoted text over the limit', maxString)
+                text = m.group(token)
+                if token == 2:
+                    push(text)
+                elif token == 3:
+                    push(Symbol(text))
+                else:
+                    # as _handleSemanticTag
+                    if self._empty(): raise FormatError('Semantic tag must follow item', text)
+                    push(Tag(text, self._pop()))
+            elif token == 6:
+                # as _handleOpenStruct, for each {
+                opened = m.end() - m.start(6)
+                if len(frames) + opened > maxDepth:
+                    raise LimitExceeded('Depth of structs over the limit', maxDepth)
+                frames.extend([len(stack)] * opened)
+            elif token == 7:
+                # the handlers read on from self._pos
+                self._pos = pos
+                ch = m.group(7)
+                while ch is not None:
+                    if ch == '#' or ch == '&':
+                        conses = True
+                    if self.dispatch.has_key(ch):
+                        ch = self.dispatch[ch](ch)
+                    else:
+                        raise FormatError('Unhandled UBF-A character', ch)
+                buf = self._buf
+                pos = self._pos
+                last = self._message_end - self._dropped
+            else:
+                self._limited_comment(m)
+
+        if pos > last:
+            raise LimitExceeded('Message over the limit', self._max_bytes)
+        self._pos = pos
+        if self.stats is not None:
+            self._report(started)
+        return self.result
+
+    def decode_all(self):
+        """Decodes the messages up to the end of the source in one loop.
+
+        Returns (messages, offset): the list of the complete messages and
+        the position where the unfinished rest of the source starts, after
+        the last $ (at the end when the source ends with a message).
+        """
+        if self.stats is not None:
+            return self._decode_all_counted()
+        if self.dispatch is None or (self._binds and not self.session):
+            self._drop_registers()
+        self.stack = []
+        self.frames = []
+        self.result = None
+        self._binds = 0
+        messages = []
+        offset = self._position()
+        self._message_end = offset + self._max_bytes
+
+        # the structs and message ends are handled here, the rest
+        # goes through the dispatch table as in decode
+        tokens = _token_re.finditer
+        stack = self.stack
+        frames = self.frames
+        push = stack.append
+        finished = self._finished
+        registers = self.registers
+        maxDepth = self._max_depth
+        maxString = self._max_string
+        # set once a _ConsList may be on the stack, only # and & push them
+        conses = False
+        buf = self._buf
+        pos = self._pos
+        dropped = self._dropped
+        try:
+            while 1:
+                # the tokens are matched up to the limit of the message,
+                # the next message starts a new match
+                end = min(len(buf), self._message_end - dropped)
+                m = None
+                for m in tokens(buf, pos, end):
+                    token = m.lastindex
+                    if token == 1:
+                        push(int(m.group(1)))
+                    elif token == 2:
+                        if m.end(2) - m.start(2) > maxString:
+                            raise LimitExceeded('Quoted text over the limit', maxString)
+                        push(m.group(2))
+                    elif token == 3:
+                        if m.end(3) - m.start(3) > maxString:
+                            raise LimitExceeded('Quoted text over the limit', maxString)
+                        push(Symbol(m.group(3)))
+                    elif token == 4:
+                        if m.end(4) - m.start(4) > maxString:
+                            raise LimitExceeded('Quoted text over the limit', maxString)
+                        text = m.group(4)
+                        if self._empty(): raise FormatError('Semantic tag must follow item', text)
+                        push(Tag(text, self._pop()))
+                    elif token == 5:
+                        run = m.group(5)
+                        try:
+                            if len(run) == 1:
+                                push(registers[run])
+                            else:
+                                stack.extend(map(registers.__getitem__, run))
+                        except KeyError as e:
+                            raise FormatError('Unhandled UBF-A character', e.args[0])
+                    elif token == 6:
+                        opened = m.end() - m.start(6)
+                        if len(frames) + opened > maxDepth:
+                            raise LimitExceeded('Depth of structs over the limit', maxDepth)
+                        frames.extend([len(stack)] * opened)
+                    elif token == 7:
+                        ch = m.group(7)
+                        if ch == '}' and frames:
+                            # as _handleCloseStruct
+                            start = frames.pop()
+                            items = stack[start:]
+                            del stack[start:]
+                            if conses and _ConsList in map(type, items):
+                                items = map(finished, items)
+                            push(tuple(items))
+                        elif ch == '$' and len(stack) == 1 and not frames:
+                            messages.append(finished(stack.pop()))
+                            offset = dropped + m.end()
+                            self._message_end = offset + self._max_bytes
+                            if self._binds and not self.session:
+                                self._drop_registers()
+                                self._binds = 0
+                            if end < len(buf):
+                                # on with the limit of the next message
+                                ch = None
+                                break
+                        else:
+                            break
+                    else:
+                        self._limited_comment(m)
+                else:
+                    if end < len(buf):
+                        raise LimitExceeded('Message over the limit', self._max_bytes)
+                    # the end of the buffer
+                    if m is not None:
+                        pos = m.end()
+                        if m.lastindex == 1 and pos == len(buf):
+                            # the integer may go on in the next chunk
+                            stack.pop()
+                            pos = m.start()
+                    self._pos = pos
+                    if not self._fill():
+                        break
+                    buf = self._buf
+                    pos = self._pos
+                    dropped = self._dropped
+                    continue
+
+                # the handlers read on from self._pos
+                self._pos = m.end()
+                while ch is not None:
+                    if ch == '#' or ch == '&':
+                        conses = True
+                    if self.dispatch.has_key(ch):
+                        ch = self.dispatch[ch](ch)
+                    else:
+                        raise FormatError('Unhandled UBF-A character', ch)
+                buf = self._buf
+                pos = self._pos
+                dropped = self._dropped
+                if self.result is not None:
+                    # ended by _handleEom, after an integer read on by hand
+                    if dropped + pos > self._message_end:
+                        raise LimitExceeded('Message over the limit', self._max_bytes)
+                    messages.append(self.result)
+                    self.result = None
+                    offset = dropped + pos
+                    self._message_end = offset + self._max_bytes
+                    if self._binds and not self.session:
+                        self._drop_registers()
+                        self._binds = 0
+        except EndOfStream:
+            pass
+        return (messages, offset)
+
+    def _decode_all_counted(self):
+        # message by message, to report the stats of each
+        messages = []
+        while 1:
+            offset = self._position()
+            try:
+                messages.append(self.decode())
+            except EndOfStream:
+                return (messages, offset)
+
+    def _position(self):
+        return self._dropped + self._pos
+
+    def _limited_comment(self, m):
+        # a comment matched whole by _token_re, after whitespace;
+        # measured in the buffer, without copying it out
+        if m.end() - m.string.index('%', m.start()) - 2 > self._max_string:
+            raise LimitExceeded('Quoted text over the limit', self._max_string)
+
+    def _chargen(self):
+        if self._pos >= len(self._buf) and not self._fill():
+            raise EndOfStream()
+        ch = self._buf[self._pos]
+        self._pos = self._pos + 1
+        return ch
+
+    # the position is counted by _pos, see _position
+    _counted_chargen = _chargen
+
+    def _collect_quoted(self, stopchar):
+        run = _quoted_run_re[stopchar].match
+        acc = []
+        # characters between the quotes, escapes included
+        size = 0
+        while 1:
+            end = run(self._buf, self._pos).end()
+            size = size + end - self._pos
+            if size > self._max_string:
+                raise LimitExceeded('Quoted text over the limit', self._max_string)
+            acc.append(self._buf[self._pos:end])
+            self._pos = end
+            char = self._chargen()
+            if char == '\\':
+                size = size + 2
+                ch2 = self._chargen()
+                if ch2 in ('\\', stopchar):
+                    acc.append(ch2)
+                else:
+                    raise FormatError('Unsupported quoted character', ch2, stopchar)
+            elif char == stopchar:
+                return string.join(acc, '')
+            else:
+                acc.append(char)
+                size = size + 1
+
+    def _handleBinary(self, firstTilde):
+        if self._empty() or type(self._peek()) not in NumTypes:
+            raise FormatError('Binary data must be preceded by length')
+        binlen = self._pop()
+        self._check_binary(binlen)
+        acc = []
+        while binlen > 0:
+            if self._pos >= len(self._buf) and not self._fill():
+                raise EndOfStream()
+            piece = self._buf[self._pos:self._pos + binlen]
+            self._pos = self._pos + len(piece)
+            binlen = binlen - len(piece)
+            acc.append(piece)
+        if self._chargen() != '~':
+            raise FormatError('Binary data must be followed by tilde')
+        self._push(Binary(string.join(acc, '')))
+        return None
+
+def decode_many(buffer, session = False, limits = None):
+    """Decodes all the complete messages of the string buffer in one call.
+
+    Returns (messages, offset) as TokenDecoder.decode_all: buffer[offset:]
+    is the start of the next message, to decode again with more data.
+    """
+    return TokenDecoder(buffer, session, limits = limits).decode_all()
+
+def decode_all(stream, session = False, chunk_size = 65536, limits = None):
+    """Decodes all the messages of a file-like object or an iterable of
+    strings, as decode_many. The offset counts the characters read.
+    """
+    return TokenDecoder(stream, session, chunk_size, limits = limits).decode_all()
+
+def _unchanged(state):
+    # the tags and binaries of a snapshot still hold the same
+    for (x, first, second) in state:
+        if isinstance(x, Tag):
+            if x.key is not first or x.value is not second:
+                return False
+        elif x.content is not first:
+            return False
+    return True
+
 class Encoder:
     regpref = list("abcdefghijklmnopqrstuvwxyz" + \
                    "ABCDEFGHIJKLMNOPQRSTUVWXYZ" + \
-                   ".,:;[]\\|+=_()*^@!")
+                   ".:;[]\\|+=_()*^@!")
     for i in range(255, -1, -1):
         ch = chr(i)
         if ch in regpref or ch in ubf_a_reserved_chars:
@@ -300,15 +970,61 @@ class Encoder:
         else:
             regpref.append(ch)
     
-    def __init__(self):
-        pass
+    def __init__(self, session = False, seen_limit = None, stats = None, cache_size = 0):
+        # stats is called with the MessageStats of each message
+        self.stats = stats
+        self._hits = 0
+        self._binds = 0
+        if stats is not None:
+            self._emitted = 0
+            emit = self.emit
+            def counted(s):
+                self._emitted = self._emitted + len(s)
+                emit(s)
+            self.emit = counted
+
+        # In a session the registers stay bound from one message to the next.
+        # The encoder keeps the table of bound terms, least recently used first.
+        # A register is reused by binding another term to it,
+        # so the decoder follows just by keeping its registers.
+        self.session = session
+        if session:
+            self.session_table = OrderedDict()
+            self.free_registers = self.regpref[::-1]
+            # terms of the earlier messages, bound when seen again
+            self.seen = OrderedDict()
+            self.seen_limit = seen_limit or 4 * len(self.regpref)
+
+        # With a cache_size, the encoded tuples and tags are kept,
+        # up to cache_size of them: {term: [fragment, last use]}.
+        # The least recently used half goes when the cache is full.
+        # They are encoded without registers, so they can be written
+        # again as they are into any message.
+        # Tags and binaries can be changed, so the terms are keyed by a
+        # snapshot where they are replaced by tuples of their contents.
+        # The same objects are found by their id first: hashing a tuple
+        # hashes all of its terms. The tags and binaries in them are
+        # checked to still hold what they held when cached.
+        self.cache_size = cache_size
+        self.cache = None
+        if cache_size:
+            self.cache = {}
+            self.cache_ids = {}
+            self.cache_clock = 0
 
     def build_table(self, object):
         table = {}
+        # the terms of the cached fragments are not counted,
+        # they are found by id, without hashing them
+        cached = self.cache is not None and self.cache_ids
         def walk(x):
             if type(x) in (types.TupleType, types.ListType):
+                if cached and cached.has_key(id(x)):
+                    return
                 for elt in x: walk(elt)
             elif isinstance(x, Tag):
+                if cached and cached.has_key(id(x)):
+                    return
                 walk(x.value)
             else:
                 if table.has_key(x):
@@ -316,19 +1032,76 @@ class Encoder:
                 else:
                     table[x] = 1
         walk(object)
-        freqtab = [(v,k) for (k,v) in table.iteritems()]
-        freqtab.sort()
+        if self.session:
+            return self._build_session_table(table)
+
+        # A term written count times takes count * length characters,
+        # bound it takes length + 3 for >rr and 1 for each later use.
+        # The registers go to the terms saving the most; ties are bound
+        # too, a register never needs the space separating integers.
+        savings = []
+        for (x, count) in table.iteritems():
+            if count > 1 and (type(x) not in NumTypes or x < 0 or x > 9):
+                saving = (count - 1) * (self._encoded_length(x) - 1) - 3
+                if saving >= 0:
+                    savings.append((saving, x))
+        best = heapq.nlargest(len(self.regpref), savings, key = lambda entry: entry[0])
+        regtab = {}
+        for ((saving, x), regname) in zip(best, self.regpref):
+            regtab[x] = [regname, False]
+        return regtab
+
+    def _encoded_length(self, x):
+        # characters of the atom written without a register
+        if type(x) in NumTypes:
+            return len(str(x))
+        if type(x) == types.StringType:
+            return len(x) + 2 + x.count('\\') + x.count('"')
+        if isinstance(x, Symbol):
+            return len(x.name) + 2 + x.name.count('\\') + x.name.count("'")
+        if isinstance(x, Binary):
+            return len(str(len(x.content))) + len(x.content) + 2
+        return 1
+
+    def _build_session_table(self, table):
         regtab = {}
-        reglist = self.regpref[:]
-        for (count, x) in freqtab:
-            if count > 1:
+        fresh = []
+        for (x, count) in table.iteritems():
+            if self.session_table.has_key(x):
+                # bound in an earlier message, mark as recently used
+                regname = self.session_table.pop(x)
+                self.session_table[x] = regname
+                regtab[x] = [regname, True]
+            elif count > 1 or self.seen.has_key(x):
                 if type(x) not in NumTypes or x < 0 or x > 9:
-                    regname = reglist[0]
-                    reglist = reglist[1:]
-                    regtab[x] = [regname, False]
+                    # characters saved in each message using it
+                    fresh.append((count * (self._encoded_length(x) - 1), x))
+
+        fresh.sort(key = lambda entry: entry[0], reverse = True)
+        for (saving, x) in fresh:
+            if self.free_registers:
+                regname = self.free_registers.pop()
+            else:
+                (old, regname) = self.session_table.popitem(last = False)
+                if regtab.has_key(old):
+                    # all registers are used in this message
+                    self.session_table[old] = regname
+                    break
+            self.session_table[x] = regname
+            regtab[x] = [regname, False]
+
+        for x in table:
+            self.seen.pop(x, None)
+            self.seen[x] = True
+        while len(self.seen) > self.seen_limit:
+            self.seen.popitem(last = False)
         return regtab
 
     def encode(self, object, buildTable = True):
+        if self.stats is not None:
+            started = (self._emitted, time.time())
+        self._hits = 0
+        self._binds = 0
         self.wrote_integer = False
         if buildTable:
             self.table = self.build_table(object)
@@ -336,46 +1109,139 @@ class Encoder:
             self.table = None
         self._encode(object)
         self.emit('$')
+        if self.session and self.table and self.cache is not None:
+            self._release_unbound()
+        if self.stats is not None:
+            (counts, depth) = _element_counts(object)
+            self.stats(MessageStats('encode', self._emitted - started[0], counts, depth,
+                                    self._hits, self._binds, time.time() - started[1]))
         return self.finish()
 
+    def _release_unbound(self):
+        # the terms found only in the newly cached fragments were
+        # never bound, the decoder does not have them in their registers
+        for (x, entry) in self.table.iteritems():
+            if not entry[1] and self.session_table.get(x) == entry[0]:
+                del self.session_table[x]
+                self.free_registers.append(entry[0])
+
     def _quote_string(self, quotechar, str):
         self.emit(quotechar)
-        for ch in str:
-            if ch in ('\\', quotechar):
-                self.emit('\\')
-            self.emit(ch)
+        if '\\' in str or quotechar in str:
+            str = str.replace('\\', '\\\\').replace(quotechar, '\\' + quotechar)
+        self.emit(str)
         self.emit(quotechar)
 
-    def _encode(self, object):
-        new_wrote_integer = False
-        entry = None
+    def _encode_cached(self, object):
+        # writes the tuple or tag from the cache, encoding it on a miss;
+        # returns False if it can not be cached
+        same = self.cache_ids.get(id(object))
+        if same is not None and _unchanged(same[1]):
+            fragment = same[2]
+        else:
+            state = []
+            found = self._fragment(object, state)
+            if found is None:
+                return False
+            (fragment, key) = found
+            if len(self.cache_ids) >= self.cache_size:
+                self.cache_ids.clear()
+            # keeps the object, so its id is not reused
+            self.cache_ids[id(object)] = (object, state, fragment, key)
+
+        if self.wrote_integer and fragment[0] in '0123456789':
+            # a tag of a positive integer
+            self.emit(' ')
+        self.emit(fragment)
+        return True
+
+    def _snapshot(self, object, state):
+        # the term with its tags and binaries replaced by tuples,
+        # appending them and what they hold to state;
+        # raises TypeError for a list, lists are not cached
+        if type(object) == types.TupleType or isinstance(object, Tag):
+            same = self.cache_ids.get(id(object))
+            if same is not None and _unchanged(same[1]):
+                state.extend(same[1])
+                return same[3]
+            if type(object) == types.TupleType:
+                return tuple([self._snapshot(x, state) for x in object])
+            state.append((object, object.key, object.value))
+            return (Tag, object.key, self._snapshot(object.value, state))
+        elif isinstance(object, Binary):
+            state.append((object, object.content, None))
+            return (Binary, object.content)
+        elif type(object) == types.ListType:
+            raise TypeError('list')
+        return object
+
+    def _fragment(self, object, state):
+        # returns the fragment and the key of the term
+        try:
+            key = self._snapshot(object, state)
+        except TypeError:
+            # holds a list
+            return None
+        entry = self.cache.get(key)
+        self.cache_clock = self.cache_clock + 1
+        if entry is not None:
+            entry[1] = self.cache_clock
+            return (entry[0], key)
+
+        (emit, table, wrote_integer) = (self.emit, self.table, self.wrote_integer)
+        parts = []
+        self.emit = parts.append
+        self.table = None
+        self.wrote_integer = False
+        try:
+            self._encode_composite(object)
+        finally:
+            (self.emit, self.table, self.wrote_integer) = (emit, table, wrote_integer)
+        fragment = string.join(parts, '')
+
+        if len(self.cache) >= self.cache_size:
+            uses = [entry[1] for entry in self.cache.itervalues()]
+            uses.sort()
+            oldest = uses[len(uses) // 2]
+            for (term, entry) in self.cache.items():
+                if entry[1] <= oldest:
+                    del self.cache[term]
+        self.cache[key] = [fragment, self.cache_clock]
+        return (fragment, key)
 
+    def _encode_composite(self, object):
         if type(object) == types.TupleType:
             self.emit('{')
             for x in object:
                 self._encode(x)
             self.emit('}')
+        else:
+            self._encode(object.value)
+            self._quote_string('`', object.key)
+
+    def _encode(self, object):
+        new_wrote_integer = False
+        entry = None
+
+        if type(object) == types.TupleType or isinstance(object, Tag):
+            if self.cache is None or not self._encode_cached(object):
+                self._encode_composite(object)
         elif type(object) == types.ListType:
             self.emit('#')
-            seq = object[:]
-            seq.reverse()
-            for x in seq:
+            for x in reversed(object):
                 self._encode(x)
                 self.emit('&')
-        elif isinstance(object, Tag):
-            self._encode(object.value)
-            self._quote_string('`', object.key)
         else:
             if self.table and self.table.has_key(object):
                 entry = self.table[object]
 
             if entry and entry[1]:
                 self.emit(entry[0])
+                self._hits = self._hits + 1
             elif type(object) in NumTypes:
                 if self.wrote_integer and object >= 0:
                     self.emit(' ')
-                for ch in str(object):
-                    self.emit(ch)
+                self.emit(str(object))
                 new_wrote_integer = True
             elif type(object) == types.StringType:
                 self._quote_string('"', object)
@@ -384,27 +1250,143 @@ class Encoder:
             elif isinstance(object, Binary):
                 self._encode(len(object.content))
                 self.emit('~')
-                for ch in object.content:
-                    self.emit(ch)
+                self.emit(object.content)
                 self.emit('~')
             else:
                 raise FormatError('Unsupported term type in ubf.Encoder._encode', object)
 
         if entry and not entry[1]:
             entry[1] = True
-            self.emit('>')
-            self.emit(entry[0])
-            self.emit(entry[0])
+            # bound and pushed back, as the decoder counts it
+            self._binds = self._binds + 1
+            self._hits = self._hits + 1
+            self.emit('>' + entry[0] + entry[0])
 
         self.wrote_integer = new_wrote_integer
 
 class StringEncoder(Encoder):
-    def __init__(self):
-        Encoder.__init__(self)
+    def __init__(self, session = False, seen_limit = None, stats = None, cache_size = 0):
+        Encoder.__init__(self, session, seen_limit, stats, cache_size)
         self.accumulator = []
 
-    def emit(self, ch):
-        self.accumulator.append(ch)
+    def emit(self, s):
+        self.accumulator.append(s)
 
     def finish(self):
-        return string.join(self.accumulator, '')
+        # the message just encoded, the next one starts afresh
+        s = string.join(self.accumulator, '')
+        self.accumulator = []
+        return s
+
+class StreamEncoder(Encoder):
+    """StreamEncoder(out, session = False, seen_limit = None, buffer_size = 65536, stats = None, cache_size = 0)
+
+    Encodes messages into a file or a socket, out is anything with
+    sendall or write. The output is collected in a buffer of
+    about buffer_size characters, and written whenever it fills up,
+    so the memory stays bounded by the buffer and not by the message.
+    Binary contents and strings of buffer_size or more are written
+    directly, without copying them into the buffer.
+
+    encode returns None, the message is written and the buffer flushed
+    when it returns.
+    """
+
+    def __init__(self, out, session = False, seen_limit = None, buffer_size = 65536, stats = None, cache_size = 0):
+        Encoder.__init__(self, session, seen_limit, stats, cache_size)
+        if hasattr(out, 'sendall'):
+            self.write = out.sendall
+        else:
+            self.write = out.write
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+
+    def emit(self, s):
+        if len(s) >= self.buffer_size:
+            self.flush()
+            self.write(s)
+            return
+        self.buffer.append(s)
+        self.buffered = self.buffered + len(s)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.write(string.join(self.buffer, ''))
+            self.buffer = []
+            self.buffered = 0
+
+    def finish(self):
+        self.flush()
+        return None
+
+if __name__ == '__main__':
+    print("running tests:")
+    # a session encoder returns each message alone, reusing the registers
+    # bound by the messages before it
+    encoder = StringEncoder(session = True)
+    session_messages = [(Symbol('hello'), 'world', 'world'), (Symbol('hello'), 'world')]
+    encoded = [encoder.encode(m) for m in session_messages]
+    print(encoded)
+    assert encoded == ['{\'hello\'"world">aaa}$', "{'hello'>bba}$"]
+    assert list(Decoder(string.join(encoded, ''), session = True)) == session_messages
+    # quoted text is held to max_string by TokenDecoder as by Decoder
+    tight = Limits(max_string = 3)
+    for text in ['"abcd"$', "'abcd'$", '1`abcd`$', ' ,%abcd% 1$']:
+        for decode in (lambda: Decoder(text, limits = tight).decode(),
+                       lambda: TokenDecoder(text, limits = tight).decode(),
+                       lambda: TokenDecoder(text, limits = tight).decode_all()):
+            try:
+                decode()
+            except LimitExceeded:
+                pass
+            else:
+                raise AssertionError('quoted text over max_string accepted')
+    assert TokenDecoder(' ,%abc% "abc"$', limits = tight).decode() == 'abc'
+
+    # registers go to the terms they make shorter, ties included
+    assert StringEncoder().encode(('a', 'a', 5, 5, 'long text', 'long text', 123, 123)) == \
+           '{"a""a"5 5"long text">aaa123 123}$'
+
+    # round trips of the encoders and the decoders
+    shared = ('shared', Symbol('shared'), 12345)
+    round_trip_messages = []
+    for i in range(20):
+        round_trip_messages.append((Symbol('call'), i, 'shared', shared, Tag('tagged', shared),
+                                    [Binary('~$' * i), 'x' * i, ['nested', -i]]))
+        round_trip_messages.append(shared)
+    for session in (False, True):
+        for cache_size in (0, 8):
+            encoder = StringEncoder(session, cache_size = cache_size)
+            encoded = [encoder.encode(m) for m in round_trip_messages]
+            assert [e[-1] for e in encoded] == ['$'] * len(encoded)
+            stream = string.join(encoded, '')
+            assert list(Decoder(stream, session)) == round_trip_messages
+            for chunk_size in (1, 7, 65536):
+                chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+                assert list(TokenDecoder(chunks, session)) == round_trip_messages
+                assert decode_all(chunks, session) == (round_trip_messages, len(stream))
+            # the unfinished message at the end is left for more data
+            assert decode_many(stream + encoded[0][:-1], session) == (round_trip_messages, len(stream))
+
+            # the stream encoder writes the same, flushing whenever the buffer
+            # fills up and at the end of each message
+            class Writes:
+                def __init__(self):
+                    self.writes = []
+                def write(self, s):
+                    self.writes.append(s)
+            out = Writes()
+            encoder = StreamEncoder(out, session, buffer_size = 8, cache_size = cache_size)
+            for m, e in zip(round_trip_messages, encoded):
+                written = len(out.writes)
+                assert encoder.encode(m) is None
+                writes = out.writes[written:]
+                assert string.join(writes, '') == e
+                # a write short of the buffer ends the message,
+                # or comes before a string written directly
+                for (w, following) in zip(writes, writes[1:]):
+                    assert len(w) >= 8 or len(following) >= 8
+    print("ok")
@@ -0,0 +1,423 @@
+
+"""
+Benchmarks of the UBF decoders and encoders.
+
+ubf runs under Python 2 and pyubf under Python 3,
+each benchmark runs whichever of them imports:
+
+    python2 ubfbench.py [--scale N] [--save FILE] [--compare FILE]
+    python3 ubfbench.py [--scale N] [--save FILE] [--compare FILE]
+    python3 ubfbench.py lists [sizes...]
+    python2 ubfbench.py registers [--scale N]
+
+The default run encodes and decodes a generated corpus
+(see CORPORA) and reports MB/s, messages/s and peak memory.
+--save merges the results into a JSON baseline,
+--compare reports the benchmarks slower than the baseline
+by more than --tolerance and exits with 1 if there are any.
+ubfbench_baseline.json is the baseline of both at scale 1,
+the speeds are of the machine it was saved on:
+save one of your own before comparing.
+
+The peak memory is traced under Python 3; under Python 2 it is
+the growth of the peak resident size of a new process running
+the benchmark alone, so it is rounded to pages and does not count
+memory freed before the benchmark and reused by it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+try:
+    import ubf
+except (ImportError, AttributeError):
+    ubf = None
+
+try:
+    import pyubf
+except (ImportError, SyntaxError):
+    pyubf = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2: the peak resident size of a process running the benchmark alone
+    tracemalloc = None
+    import resource
+
+
+def timed(f, *args):
+    start = time.time()
+    out = f(*args)
+    return out, time.time() - start
+
+
+def bench_lists(sizes):
+    """bench_lists(sizes)
+
+    Decodes and encodes lists of the given lengths.
+    The time per element stays flat when building lists is linear.
+    """
+
+    print("%-34s %10s %10s %12s" % ("list", "elements", "seconds", "us/element"))
+
+    def report(name, n, seconds):
+        print("%-34s %10d %10.3f %12.3f" % (name, n, seconds, seconds * 1e6 / n))
+
+    for n in sizes:
+        if ubf is not None:
+            data, seconds = timed(ubf.StringEncoder().encode, list(range(n)), False)
+            report("ubf.StringEncoder", n, seconds)
+            for decoder in (ubf.Decoder, ubf.TokenDecoder):
+                out, seconds = timed(lambda: decoder(data).decode())
+                assert len(out) == n
+                report("ubf." + decoder.__name__, n, seconds)
+
+        if pyubf is not None:
+            data, seconds = timed(pyubf.encode, list(range(n)), False)
+            report("pyubf.encode", n, seconds)
+            out, seconds = timed(lambda: pyubf.IncrementalRecognitionStack().feed(data)[0])
+            assert len(out) == n
+            report("pyubf.IncrementalRecognitionStack", n, seconds)
+            out, seconds = timed(lambda: pyubf.RecognitionStack(data).recognize()[0])
+            assert len(out) == n
+            report("pyubf.RecognitionStack", n, seconds)
+            out, seconds = timed(lambda: pyubf.MappedRecognitionStack(data, int_arrays=True).recognize()[0])
+            assert len(out) == n
+            report("pyubf int_arrays", n, seconds)
+            data, seconds = timed(pyubf.encode, out, False)
+            report("pyubf.encode UBF_IntList", n, seconds)
+
+
+# Corpus
+#
+# The messages are generated as plain tuples, lists and ints
+# with the atoms below, and converted to the elements of each implementation.
+
+class Str(str):
+    pass
+
+class Sym(str):
+    pass
+
+class Bin(bytes):
+    pass
+
+class Tagged(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+def _text(r, low, high):
+    return "".join(r.choice("abcdefghijklmnopqrstuvwxyz0123456789 \"'\\$~")
+                   for _ in range(r.randrange(low, high)))
+
+def _binary(r, n):
+    return Bin(bytes(bytearray(r.randrange(256) for _ in range(n))))
+
+def deep_nesting(r, scale):
+    messages = []
+    for _ in range(50 * scale):
+        x = r.randrange(1000)
+        for _ in range(200):
+            x = (x, Sym("k"), r.randrange(100))
+        messages.append(x)
+    return messages
+
+def long_lists(r, scale):
+    return [[r.randrange(-10 ** 9, 10 ** 9) for _ in range(20000)] for _ in range(5 * scale)]
+
+def large_binaries(r, scale):
+    # the same random block, generating it is slow
+    block = _binary(r, 1 << 16)
+    return [(Str("blob"), Bin(block * 4)) for _ in range(4 * scale)]
+
+def short_strings(r, scale):
+    return [tuple(Str(_text(r, 1, 10)) for _ in range(200)) for _ in range(100 * scale)]
+
+def registers(r, scale):
+    atoms = [Sym("sym%d" % i) for i in range(10)] + [Str("str%d" % i) for i in range(10)] + \
+            [1000 + i for i in range(10)]
+    return [tuple(r.choice(atoms) for _ in range(100)) for _ in range(200 * scale)]
+
+def semantic_tags(r, scale):
+    return [tuple(Tagged("tag%d" % r.randrange(5), r.choice([r.randrange(1000), Str(_text(r, 1, 10))]))
+                  for _ in range(50)) for _ in range(200 * scale)]
+
+CORPORA = [deep_nesting, long_lists, large_binaries, short_strings, registers, semantic_tags]
+
+def corpus(scale = 1, seed = 1):
+    """corpus(scale = 1, seed = 1)
+
+    Returns [(name, messages)] of CORPORA,
+    the same for the same scale and seed.
+    """
+
+    return [(make.__name__, make(random.Random(seed), scale)) for make in CORPORA]
+
+def to_ubf(x):
+    if isinstance(x, Sym):
+        return ubf.Symbol(str(x))
+    if isinstance(x, Str):
+        return str(x)
+    if isinstance(x, Bin):
+        return ubf.Binary(bytes(x))
+    if isinstance(x, Tagged):
+        return ubf.Tag(x.name, to_ubf(x.value))
+    if isinstance(x, tuple):
+        return tuple([to_ubf(y) for y in x])
+    if isinstance(x, list):
+        return [to_ubf(y) for y in x]
+    return x
+
+def to_pyubf(x):
+    if isinstance(x, Sym):
+        return pyubf.UBF_Const(x)
+    if isinstance(x, Str):
+        return pyubf.UBF_Str(x)
+    if isinstance(x, Bin):
+        return pyubf.UBF_Bin(x)
+    if isinstance(x, Tagged):
+        return pyubf.tagged(to_pyubf(x.value), pyubf.UBF_Str(x.name))
+    if isinstance(x, tuple):
+        return pyubf.UBF_Tuple(to_pyubf(y) for y in x)
+    if isinstance(x, list):
+        return pyubf.UBF_List(to_pyubf(y) for y in x)
+    return pyubf.UBF_Int(x)
+
+
+# Suite
+
+def _ubf_benchmarks(messages):
+    elements = [to_ubf(m) for m in messages]
+    data = "".join([ubf.StringEncoder().encode(m) for m in elements])
+
+    def decode(decoder):
+        return lambda: list(decoder(data))
+
+    return data, [("ubf.StringEncoder", lambda: [ubf.StringEncoder().encode(m) for m in elements]),
+                  ("ubf.Decoder", decode(ubf.Decoder)),
+                  ("ubf.TokenDecoder", decode(ubf.TokenDecoder)),
+                  ("ubf.decode_many", lambda: ubf.decode_many(data)[0])]
+
+def _pyubf_benchmarks(messages):
+    elements = [to_pyubf(m) for m in messages]
+    data = b"".join([pyubf.encode(m) for m in elements])
+    n = len(elements)
+
+    def recognize(stack):
+        return [stack.recognize()[0] for _ in range(n)]
+
+    return data, [("pyubf.encode", lambda: [pyubf.encode(m) for m in elements]),
+                  ("pyubf.RecognitionStack", lambda: recognize(pyubf.RecognitionStack(io.BytesIO(data)))),
+                  ("pyubf.BufferedRecognitionStack", lambda: recognize(pyubf.BufferedRecognitionStack(io.BytesIO(data)))),
+                  ("pyubf.MappedRecognitionStack", lambda: list(pyubf.MappedRecognitionStack(data))),
+                  ("pyubf.decode_many", lambda: pyubf.decode_many(data)[0])]
+
+def _peak_memory(f):
+    # bytes allocated at the peak of f,
+    # under Python 2 the growth of the peak resident size of a child running f:
+    # a forked process starts its peak at its current size,
+    # not at the earlier peaks of this one
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            f()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            f()
+            os.write(write, str((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024))
+        finally:
+            os._exit(0)
+    os.close(write)
+    try:
+        peak = os.read(read, 64)
+    finally:
+        os.close(read)
+        os.waitpid(pid, 0)
+    if not peak:
+        raise RuntimeError("the benchmark failed in the child process")
+    return int(peak)
+
+def _benchmark(bench, name, scale):
+    # the function of the benchmark over the named corpus, made as in run_suite
+    make = dict((make.__name__, make) for make in CORPORA)[name]
+    messages = make(random.Random(1), scale)
+    suite = _ubf_benchmarks if bench.startswith("ubf.") else _pyubf_benchmarks
+    return dict(suite(messages)[1])[bench]
+
+def _fresh_peak_memory(bench, name, scale):
+    # _peak_memory in a new interpreter: the memory freed by the earlier benchmarks
+    # stays with this one (free lists, arenas), and would be reused without growing
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "peak", bench, name, str(scale)])
+    return int(out)
+
+def run_suite(scale = 1, repeat = 3):
+    """run_suite(scale = 1, repeat = 3)
+
+    Runs the encoders and decoders which import over the corpus.
+    Returns {"benchmark/corpus": {"mb_s", "msgs_s", "peak_kb"}},
+    the speeds are of the best of repeat runs.
+    """
+
+    print("%-32s %-16s %8s %10s %12s %10s" % ("benchmark", "corpus", "MB", "MB/s", "msgs/s", "peak KB"))
+    results = {}
+    for name, messages in corpus(scale):
+        suites = []
+        if ubf is not None:
+            suites.append(_ubf_benchmarks(messages))
+        if pyubf is not None:
+            suites.append(_pyubf_benchmarks(messages))
+
+        for data, benchmarks in suites:
+            megabytes = len(data) / 1e6
+            for bench, f in benchmarks:
+                out = f()
+                assert len(out) == len(messages), (bench, name, len(out))
+                seconds = min(timed(f)[1] for _ in range(repeat))
+                if tracemalloc is not None:
+                    peak = _peak_memory(f)
+                else:
+                    peak = _fresh_peak_memory(bench, name, scale)
+                result = {"mb_s": megabytes / seconds,
+                          "msgs_s": len(messages) / seconds,
+                          "peak_kb": peak // 1024}
+                results[bench + "/" + name] = result
+                print("%-32s %-16s %8.2f %10.2f %12.1f %10d" % (bench, name, megabytes,
+                      result["mb_s"], result["msgs_s"], result["peak_kb"]))
+    return results
+
+
+# Register allocation
+
+def _legacy_table(encoder, object):
+    # ubf.Encoder.build_table before it weighed the bytes saved:
+    # every term seen twice, the least frequent first
+    table = {}
+    def walk(x):
+        if type(x) in (tuple, list):
+            for elt in x: walk(elt)
+        elif isinstance(x, ubf.Tag):
+            walk(x.value)
+        else:
+            table[x] = table.get(x, 0) + 1
+    walk(object)
+    freqtab = sorted((v, k) for (k, v) in table.items())
+    regtab = {}
+    reglist = encoder.regpref[:]
+    for (count, x) in freqtab:
+        if count > 1 and reglist:
+            if not isinstance(x, int) or x < 0 or x > 9:
+                regtab[x] = [reglist.pop(0), False]
+    return regtab
+
+def bench_registers(scale = 1, repeat = 3):
+    """bench_registers(scale = 1, repeat = 3)
+
+    Encodes the corpus with ubf.Encoder.build_table
+    and with the table it replaced, reports the output size and time.
+    """
+
+    class LegacyEncoder(ubf.StringEncoder):
+        build_table = _legacy_table
+
+    print("%-16s %-8s %12s %10s %10s" % ("corpus", "table", "characters", "seconds", "decodes"))
+    for name, messages in corpus(scale):
+        elements = [to_ubf(m) for m in messages]
+        for table, encoder in (("legacy", LegacyEncoder), ("saving", ubf.StringEncoder)):
+            encode = lambda: [encoder().encode(m) for m in elements]
+            data = "".join(encode())
+            seconds = min(timed(encode)[1] for _ in range(repeat))
+            decodes = list(ubf.TokenDecoder(data)) == elements
+            print("%-16s %-8s %12d %10.3f %10s" % (name, table, len(data), seconds, decodes))
+
+
+# Baseline
+
+def save_baseline(path, results):
+    """save_baseline(path, results)
+
+    Merges the results into the baseline file,
+    so the runs under Python 2 and 3 can share one.
+    """
+
+    try:
+        with open(path) as f:
+            baseline = json.load(f)
+    except (IOError, ValueError):
+        baseline = {}
+    baseline.update(results)
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+
+def compare_baseline(path, results, tolerance = 0.2):
+    """compare_baseline(path, results, tolerance = 0.2)
+
+    Prints the change in MB/s of each benchmark found in the baseline.
+    Returns the keys of the ones slower by more than tolerance.
+    """
+
+    with open(path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    print()
+    print("%-49s %10s %10s %8s" % ("against " + path, "MB/s", "baseline", "change"))
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        now, before = results[key]["mb_s"], baseline[key]["mb_s"]
+        change = now / before - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print("%-49s %10.2f %10.2f %+7.0f%%%s" % (key, now, before, change * 100, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ["peak"]:
+        # run by _fresh_peak_memory: peak bench corpus scale
+        print(_peak_memory(_benchmark(sys.argv[2], sys.argv[3], int(sys.argv[4]))))
+        sys.exit(0)
+    if sys.argv[1:2] == ["lists"]:
+        sizes = [int(a) for a in sys.argv[2:]] or [10000, 100000, 1000000]
+        bench_lists(sizes)
+        sys.exit(0)
+    if sys.argv[1:2] == ["registers"]:
+        parser = argparse.ArgumentParser(description="ubf register allocation against the legacy table.")
+        parser.add_argument("--scale", type=int, default=1, help="multiplies the number of messages")
+        parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the best is kept")
+        args = parser.parse_args(sys.argv[2:])
+        bench_registers(args.scale, args.repeat)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmarks of ubf and pyubf over a generated corpus.")
+    parser.add_argument("--scale", type=int, default=1, help="multiplies the number of messages")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the best is kept")
+    parser.add_argument("--save", metavar="FILE", help="merge the results into the baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    results = run_suite(args.scale, args.repeat)
+    if args.save:
+        save_baseline(args.save, results)
+    if args.compare and compare_baseline(args.compare, results, args.tolerance):
+        sys.exit(1)